@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Watchlist load time and lookups per second against the size of the list.
+
+The index is compared with the scan islisted.py used to do, which read
+the file line by line for every lookup. Half of the codes looked up are
+on the list.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+import watchlist
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+
+# Lookups timed for the index, and the most lines the old scan may read
+LOOKUPS = 100000
+SCANNED = 10000000
+
+
+def value_exists_in_file(value, filename):
+    """The old scan, for comparison."""
+    with open(filename, 'r') as file:
+        for line in file:
+            if line.strip() == value:
+                return True
+    return False
+
+
+def write(filename, size, generator):
+    """Write a watchlist of size random codes, returns them."""
+    codes = ['%06x' % code for code in generator.sample(range(1 << 24), size)]
+    with open(filename, 'w') as file:
+        file.write('# benchmark watchlist\n')
+        file.write('\n'.join(codes) + '\n')
+    return codes
+
+
+def queries(codes, count, generator):
+    """Codes to look up, half of them on the list."""
+    listed = set(codes)
+    found = [generator.choice(codes) for _ in range(count // 2)]
+    missing = []
+    while len(missing) < count - len(found):
+        code = '%06x' % generator.randrange(1 << 24)
+        if code not in listed:
+            missing.append(code)
+    values = found + missing
+    generator.shuffle(values)
+    return values
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    generator = random.Random(1)
+    print('    Size  Ranges  load ms  index lookups/s  scan lookups/s')
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'aircraft.txt')
+        for size in sizes:
+            codes = write(filename, size, generator)
+
+            start = time.perf_counter()
+            index = watchlist.load(filename)
+            loaded = time.perf_counter() - start
+
+            values = queries(codes, LOOKUPS, generator)
+            start = time.perf_counter()
+            for value in values:
+                value in index
+            indexed = len(values) / (time.perf_counter() - start)
+
+            values = values[:max(SCANNED // size, 10)]
+            start = time.perf_counter()
+            for value in values:
+                value_exists_in_file(value, filename)
+            scanned = len(values) / (time.perf_counter() - start)
+
+            print('%8d %7d %8.1f %16.0f %15.1f' % (size, index.ranges(), loaded * 1000,
+                                                     indexed, scanned))
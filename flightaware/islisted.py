@@ -1,29 +1,45 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""Print 1 if an aircraft is on the watchlist, 0 if it is not.
+
+The lookup service (watchlistd.py) is asked if it is running, otherwise
+the watchlist is read here. Given several codes, a 1 or 0 is printed for
+each one in order.
+"""
+
+import socket
 import sys
 
-def value_exists_in_file(value, filename='data.txt'):
+import watchlist
+
+
+def ask_service(values, path=watchlist.DEFAULT_SOCKET):
+    """Ask the lookup service, returns the answer or None if it is not running."""
     try:
-        with open(filename, 'r') as file:
-            for line in file:
-                if line.strip() == value:
-                    return True
-        return False
-    except FileNotFoundError:
-        print(f'The file {filename} does not exist.')
-        return False
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(5)
+            client.connect(path)
+            client.sendall((' '.join(values) + '\n').encode('ascii', 'replace'))
+            answer = b''
+            while not answer.endswith(b'\n'):
+                data = client.recv(4096)
+                if not data:
+                    return None
+                answer += data
+    except OSError:
+        return None
+    return answer.decode('ascii').strip()
+
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('Usage: python check_value.py <value_to_check>')
+    if len(sys.argv) < 2:
+        print('Usage: python islisted.py <value_to_check> [<value_to_check> ...]')
         sys.exit(2)
 
-    value_to_check = sys.argv[1]
-    filename = '/home/pi/pi-code/flightaware/aircraft.txt'
-
-    if value_exists_in_file(value_to_check, filename):
-        print('1', end='')
-    else:
-        print('0', end='')
-        
+    values = sys.argv[1:]
+    answer = ask_service(values)
+    if answer is None or len(answer) != len(values):
+        codes = watchlist.Watchlist()
+        answer = ''.join('1' if found else '0' for found in codes.lookup(values))
+    print(answer, end='')
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The aircraft watchlist, loaded once and reloaded when the file changes.
+
+Each line of the file is one entry, matched whatever its case:
+
+    43c6df              a single ICAO hex code
+    43c6e0-43c6e5       every code from the first to the last
+    43c75x or 43c75*    every code starting 43c75 (one x for each missing digit)
+
+Anything after a # is a comment, and blank lines are ignored. The entries
+are compiled into a sorted list of non-overlapping ranges of 24-bit
+integers, which is searched with bisect. An entry that is not hex is
+matched as it is.
+"""
+
+import array
+import bisect
+import os
+import threading
+
+# The watchlist next to these scripts
+DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aircraft.txt')
+
+# Where the lookup service listens
+DEFAULT_SOCKET = '/tmp/islisted.sock'
+
+# ICAO addresses are 24 bits, six hex digits
+DIGITS = 6
+
+HEX = frozenset('0123456789abcdef')
+
+
+class Watchlist:
+    """The entries in a watchlist file, as an index."""
+
+    def __init__(self, filename=DEFAULT_FILE):
+        self.filename = filename
+        self.codes = WatchlistIndex([], [])
+        self.mtime = None
+        self.missing = False
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Load the file again if it has changed since it was last loaded."""
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            # Keep the codes already loaded, and only say so once
+            if not self.missing:
+                print(f'The file {self.filename} does not exist.')
+            self.missing = True
+            return False
+        self.missing = False
+        if mtime == self.mtime:
+            return False
+        with self.lock:
+            if mtime != self.mtime:
+                self.codes = load(self.filename)
+                self.mtime = mtime
+        return True
+
+    def __contains__(self, value):
+        return value in self.codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, values):
+        """Check many codes at once, after reloading the file if it has changed."""
+        self.refresh()
+        codes = self.codes
+        return [value in codes for value in values]
+
+
+class WatchlistIndex:
+    """Sorted, non-overlapping ranges of codes, and entries that are not hex."""
+
+    def __init__(self, ranges, others=()):
+        starts = []
+        ends = []
+        last = -2
+        # Merge ranges that overlap or touch, so one search finds any code
+        for (start, end) in sorted(ranges):
+            if start <= last + 1:
+                if end > last:
+                    ends[-1] = last = end
+            else:
+                starts.append(start)
+                ends.append(end)
+                last = end
+        self.starts = array.array('I', starts)
+        self.ends = array.array('I', ends)
+        self.others = frozenset(others)
+
+    def __contains__(self, value):
+        value = value.strip().lower()
+        if len(value) == DIGITS and HEX.issuperset(value):
+            code = int(value, 16)
+            i = bisect.bisect_right(self.starts, code) - 1
+            return i >= 0 and code <= self.ends[i]
+        return value in self.others
+
+    def __len__(self):
+        """The number of codes covered."""
+        return sum(end - start + 1 for (start, end) in zip(self.starts, self.ends)) + \
+            len(self.others)
+
+    def ranges(self):
+        """The number of ranges the codes are held in."""
+        return len(self.starts)
+
+
+def parse(entry):
+    """The (start, end) codes of a hex entry, None if it is not hex."""
+    if '-' in entry:
+        (first, _, last) = entry.partition('-')
+        start = parse(first.strip())
+        end = parse(last.strip())
+        if start is None or end is None or start[0] > end[1]:
+            return None
+        return (start[0], end[1])
+    prefix = entry.rstrip('x*')
+    suffix = entry[len(prefix):]
+    # Either a * or enough xs to make up the six digits
+    if suffix != '*' and (suffix.strip('x') or len(entry) != DIGITS):
+        return None
+    if len(prefix) > DIGITS or not HEX.issuperset(prefix):
+        return None
+    # Fill the missing digits with 0s for the start and fs for the end
+    missing = DIGITS - len(prefix)
+    start = int(prefix or '0', 16) << (4 * missing)
+    return (start, start + (1 << (4 * missing)) - 1)
+
+
+def load(filename):
+    """Read the entries of a watchlist file into an index."""
+    ranges = []
+    others = set()
+    with open(filename, 'r') as file:
+        for line in file:
+            entry = line.partition('#')[0].strip().lower()
+            if not entry:
+                continue
+            # Most entries are single codes
+            if len(entry) == DIGITS and HEX.issuperset(entry):
+                code = int(entry, 16)
+                ranges.append((code, code))
+                continue
+            found = parse(entry)
+            if found is None:
+                others.add(entry)
+            else:
+                ranges.append(found)
+    return WatchlistIndex(ranges, others)
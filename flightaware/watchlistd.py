@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Answer watchlist lookups without starting a process for each aircraft.
+
+Each request is a line of hex codes separated by spaces or commas, and the
+answer is a line with a 1 or a 0 for each code, in order, e.g.
+
+    43c6df 400abc 4079fa  ->  101
+
+Requests are read from a Unix socket (several clients at once), or from
+stdin with answers on stdout when run with --stdio. The watchlist is
+loaded once and loaded again whenever the file changes.
+"""
+
+import argparse
+import os
+import signal
+import socketserver
+import stat
+import sys
+
+import watchlist
+
+
+def answer(codes, line):
+    """The answer line for a request line."""
+    values = line.replace(',', ' ').split()
+    return ''.join('1' if found else '0' for found in codes.lookup(values))
+
+
+class LookupHandler(socketserver.StreamRequestHandler):
+    """Answer each line a client sends until it disconnects."""
+
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write((answer(self.server.codes, line.decode('ascii', 'replace'))
+                              + '\n').encode('ascii'))
+
+
+class LookupServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, codes):
+        self.codes = codes
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, LookupHandler)
+
+
+def serve_stdio(codes):
+    """Answer requests from stdin on stdout until stdin closes."""
+    for line in sys.stdin:
+        sys.stdout.write(answer(codes, line) + '\n')
+        sys.stdout.flush()
+
+
+def stop(signum, frame):
+    """Stop serving when terminated, the same as when interrupted."""
+    raise KeyboardInterrupt
+
+
+def serve_socket(codes, path):
+    """Answer requests on a Unix socket until interrupted or terminated."""
+    signal.signal(signal.SIGTERM, stop)
+    # A socket left behind by an earlier run is in the way
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    server = LookupServer(path, codes)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watchlist lookup service')
+    parser.add_argument('--file', default=watchlist.DEFAULT_FILE,
+                        help=f'watchlist file (default {watchlist.DEFAULT_FILE})')
+    parser.add_argument('--socket', default=watchlist.DEFAULT_SOCKET,
+                        help=f'Unix socket to listen on (default {watchlist.DEFAULT_SOCKET})')
+    parser.add_argument('--stdio', action='store_true',
+                        help='answer requests from stdin on stdout instead of on the socket')
+    args = parser.parse_args()
+
+    codes = watchlist.Watchlist(args.file)
+    if args.stdio:
+        serve_stdio(codes)
+    else:
+        print(f'{len(codes)} codes in {codes.codes.ranges()} ranges loaded from {args.file}, '
+              f'listening on {args.socket}')
+        serve_socket(codes, args.socket)
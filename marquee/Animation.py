@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Render and play animation files for the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+Usage: Animation.py render FILE TEXT...       render text (with [] commands) into FILE
+       Animation.py play [--loop] FILE...     play files one after another
+       Animation.py info FILE...              describe files
+"""
+
+# Library Imports
+import argparse
+import sys
+import time
+
+import Marquee
+import MarqueeAnimation
+import MarqueeIngest
+
+# The commands that change how a message is rendered, the rest need the hosts or the console
+RENDERING = MarqueeIngest.DISPLAY | {"font", "sleep", "sleeptime", "log"}
+
+def main(argv=None):
+    "Main Function"
+
+    parser = argparse.ArgumentParser(description="Render and play Marquee animation files")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("render", help="render a message into an animation file")
+    command.add_argument("file")
+    command.add_argument("text", nargs="+", help="the message, with any [] commands")
+    command = commands.add_parser("play", help="play animation files one after another")
+    command.add_argument("files", nargs="+")
+    command.add_argument("--loop", action="store_true", help="play the files over and over")
+    command.add_argument("--repeat", type=int, default=0,
+                         help="play the files this many more times (default 0)")
+    command.add_argument("--sleep", type=float,
+                         help="seconds between frames (default as each file was saved)")
+    command.add_argument("--local", action="store_true",
+                         help="show the frames on the terminal instead of the Blinkt! hosts")
+    command = commands.add_parser("info", help="describe animation files")
+    command.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "render":
+        return render(args.file, " ".join(args.text))
+    if args.command == "play":
+        return play(args.files, -1 if args.loop else args.repeat, args.sleep, args.local)
+    if args.command == "info":
+        return info(args.files)
+    parser.print_help()
+    return 2
+
+def render(path, text):
+    "Render a message the same way it would be shown when typed at the prompt"
+
+    engine = Marquee.MarqueeEngine(None, Marquee.MarqueeScheduler())
+    engine.submit(MarqueeIngest.COMMANDS.sub(rendering, text))
+    if engine.message is None:
+        Marquee.marquelog(1, "There is no text to render")
+        return 1
+    engine.save(path)
+    return 0
+
+def rendering(match):
+    "Keep the commands in [] that change how a message is rendered, reporting the rest"
+
+    kept = []
+    for word in match.group(1).split(";"):
+        if word.partition(":")[0].strip().lower() in RENDERING:
+            kept.append(word)
+        elif word.strip():
+            Marquee.marquelog(1, "[" + word + "] can't be used when rendering to a file")
+    return "[" + ";".join(kept) + "]" if kept else ""
+
+def load(paths):
+    "Open animation files, returns None if any can't be played"
+
+    animations = []
+    for path in paths:
+        try:
+            animation = MarqueeAnimation.MarqueeAnimation(path)
+        except (OSError, ValueError) as error:
+            Marquee.marquelog(1, "Can't open " + path + ": " + str(error))
+            return None
+        if not animation.fits(Marquee.STACKS, Marquee.ROWS, Marquee.LAMPS):
+            Marquee.marquelog(1, path + " was made for a different size of display")
+            return None
+        animations.append(animation)
+    return animations
+
+def play(paths, repeat, sleep, local):
+    "Stream animation files to the Blinkt! hosts, or the terminal"
+
+    animations = load(paths)
+    if animations is None:
+        return 1
+    playlist = MarqueeAnimation.MarqueePlaylist(animations, repeat)
+
+    hosts = None
+    terminal = None
+    if local:
+        terminal = Marquee.MarqueeTerminal()
+        idle = time.sleep
+    else:
+        hosts = Marquee.MarqueeHosts()
+        hosts.opensocket()
+        hosts.negotiate()
+        idle = hosts.service
+
+    scheduler = Marquee.MarqueeScheduler()
+    scheduler.start()
+    try:
+        while playlist.current() is not None:
+            # Each file plays at the speed it was saved at
+            Marquee.MarqueeSleepTime.seconds = sleep or \
+                playlist.animations[playlist.playing].period
+            if local:
+                terminal.draw(playlist.current(), 0)
+            else:
+                Marquee.sendframe(hosts, playlist.current(), 0, scheduler.current)
+            playlist.advance(scheduler.wait(idle))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        playlist.close()
+        if local:
+            terminal.stop()
+        else:
+            hosts.closesocket()
+    return 0
+
+def info(paths):
+    "Describe animation files"
+
+    for path in paths:
+        try:
+            animation = MarqueeAnimation.MarqueeAnimation(path)
+        except (OSError, ValueError) as error:
+            Marquee.marquelog(1, "Can't open " + path + ": " + str(error))
+            continue
+        print("%s: %d frames of %d stacks x %d rows x %d lamps, %.3fs each (%.1fs), %d bytes" % (
+            path, len(animation), animation.stacks, animation.rows, animation.lamps,
+            animation.period, len(animation) * animation.period,
+            len(animation) * animation.framesize))
+        animation.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+Usage: Benchmark.py <benchmark> [...]
+"""
+
+# Library Imports
+import io
+import sys
+import time
+
+import Marquee
+from Marquee import ROWS, STACKS, LAMPS
+import MarqueeProtocol
+import MarqueeTopology
+
+# Message lengths (in characters) used by the scaling benchmarks
+LENGTHS = [10, 100, 1000, 5000]
+
+# Cluster sizes (stacks, rows) used by the node scaling benchmark
+TOPOLOGIES = [(4, 5), (10, 10), (20, 10), (4, 25), (20, 25), (40, 25)]
+
+def main(argv):
+    "Main Function"
+
+    if len(argv) < 2 or argv[1] not in BENCHMARKS:
+        print("Usage: Benchmark.py <" + "|".join(sorted(BENCHMARKS)) + ">")
+        return 2
+
+    return BENCHMARKS[argv[1]](argv[2:])
+
+def message(length):
+    "Build a message of a given length from the printable font characters"
+    text = "The quick brown fox jumps over the lazy dog. "
+    return (text * (length // len(text) + 1))[:length]
+
+def render(text):
+    "Render text into a display buffer the same way Marquee.main does"
+    fgcolour = (255, 255, 255)
+    bgcolour = (0, 0, 0)
+    output = Marquee.MarqueeDisplay()
+    output.addrows(Marquee.glyph("Padding", bgcolour, fgcolour))
+    for letter in text:
+        output.addrows(Marquee.glyph(letter, bgcolour, fgcolour))
+        output.addrows(Marquee.glyph("Seperator", bgcolour, fgcolour))
+    output.addrows(Marquee.glyph("Padding", bgcolour, fgcolour))
+    return output
+
+def legacycharacter(letter, bgcolour, fgcolour):
+    "Get the lamp array for a character the way Marquee used to, for comparison"
+    chararray = [[], [], [], [], []]
+    font = Marquee.MarqueeFont()
+    if letter in list(font.letter):
+        pattern = font.letter[letter]
+    else:
+        pattern = font.letter["Block"]
+    for row in range(0, ROWS):
+        for pixel in pattern[row]:
+            if pixel:
+                chararray[row].append(fgcolour)
+            else:
+                chararray[row].append(bgcolour)
+    return chararray
+
+def legacyadd(output, data):
+    "Merge a lamp array into a display buffer the way Marquee used to, for comparison"
+    columns = len(data[0])
+    output.reserve(output.width + columns)
+    for row in range(0, ROWS):
+        start = (row * output.capacity + output.width) * 3
+        output.buffer[start:start+columns*3] = bytes(
+            colour for pixel in data[row] for colour in pixel)
+    output.width += columns
+
+def legacytokens(string):
+    "Split input into commands and characters the way Marquee used to, for comparison"
+    tokens = []
+    while len(string) > 0:
+        if string[0] == "[":
+            position = string.find("]")
+            if position == -1:
+                break
+            tokens.append(string[1:position])
+            position = position + 1
+        else:
+            tokens.append(string[0])
+            position = 1
+        string = string[position:]
+    return tokens
+
+def report(name, length, steps, seconds):
+    "Print one line of benchmark results"
+    print("%-8s %6d chars %8d steps %10.2f us/step" %
+          (name, length, steps, seconds * 1e6 / max(steps, 1)))
+
+def bench_scroll(_args):
+    "Per step cost of scrolling the frame buffer against message length"
+
+    for length in LENGTHS:
+        output = render(message(length))
+
+        # Legacy layout, five lists of tuples with the first column deleted each step
+        element = [[tuple(output.window(row, column, 1)) for column in range(output.width)]
+                   for row in range(ROWS)]
+        steps = len(element[0]) - STACKS * LAMPS
+        start = time.perf_counter()
+        for _ in range(steps):
+            for row in range(ROWS):
+                for stack in range(STACKS):
+                    lights = element[row][stack*LAMPS:stack*LAMPS+LAMPS]
+            for row in range(ROWS):
+                del element[row][0]
+        report("lists", length, steps, time.perf_counter() - start)
+
+        # Frame buffer, a window view at each offset
+        steps = output.width - STACKS * LAMPS
+        start = time.perf_counter()
+        for offset in range(steps):
+            for row in range(ROWS):
+                for stack in range(STACKS):
+                    lights = output.window(row, offset + stack * LAMPS, LAMPS)
+        output.discard(steps)
+        report("buffer", length, steps, time.perf_counter() - start)
+        del lights
+
+    return 0
+
+def bench_glyphs(_args):
+    "Characters per second rendered into the display buffer"
+
+    fgcolour = (255, 255, 255)
+    bgcolour = (0, 0, 0)
+    text = message(20000)
+
+    output = Marquee.MarqueeDisplay()
+    start = time.perf_counter()
+    for letter in text:
+        legacyadd(output, legacycharacter(letter, bgcolour, fgcolour))
+        legacyadd(output, legacycharacter("Seperator", bgcolour, fgcolour))
+    seconds = time.perf_counter() - start
+    print("%-8s %10.0f chars/s" % ("lists", len(text) / seconds))
+
+    output = Marquee.MarqueeDisplay()
+    Marquee.renderglyph.cache_clear()
+    start = time.perf_counter()
+    for letter in text:
+        output.addrows(Marquee.glyph(letter, bgcolour, fgcolour))
+        output.addrows(Marquee.glyph("Seperator", bgcolour, fgcolour))
+    seconds = time.perf_counter() - start
+    print("%-8s %10.0f chars/s  %s" % ("atlas", len(text) / seconds,
+                                       Marquee.renderglyph.cache_info()))
+    return 0
+
+def bench_markup(_args):
+    "Time to tokenise a line of input against its length, the old way and compiled"
+
+    for length in LENGTHS + [50000]:
+        text = "[alternate:blue,white]" + message(length)
+        legacy = "".join(("[fg:blue]" if i % 2 else "[fg:white]") + letter
+                         for (i, letter) in enumerate(message(length)))
+        start = time.perf_counter()
+        legacytokens(legacy)
+        report("legacy", length, 1, time.perf_counter() - start)
+        Marquee.compilemarkup.cache_clear()
+        start = time.perf_counter()
+        Marquee.compilemarkup(text)
+        report("compile", length, 1, time.perf_counter() - start)
+        start = time.perf_counter()
+        Marquee.compilemarkup(text)
+        report("cached", length, 1, time.perf_counter() - start)
+    return 0
+
+def looptopology(stacks, rows, port=15000):
+    "A topology with every node on its own loopback port and broadcasts sent once to port"
+    nodes = {}
+    for stack in range(0, stacks):
+        for row in range(0, rows):
+            nodes[(stack, row)] = ("127.0.0.1", port + 1 + stack * rows + row, True)
+    return MarqueeTopology.MarqueeTopology(stacks=stacks, rows=rows, lamps=LAMPS, port=port,
+                                           address="127.0.0.1", broadcast="127.0.0.1", nodes=nodes)
+
+def bench_nodes(args):
+    """Frame encode and send time against the number of nodes
+
+    Nodes are on unused loopback ports, so packets are sent but nobody
+    reads them. Every node is sent every frame (each frame is a keyframe).
+    Spread is the median time from the first to the last packet of a
+    frame leaving.
+    """
+
+    frames = int(args[0]) if args else 200
+    original = Marquee.TOPOLOGY
+    print("Stacks Rows Nodes  Mode       Packets    Bytes  encode us/frame"
+          "  send us/frame  spread us")
+    try:
+        for (stacks, rows) in TOPOLOGIES:
+            Marquee.configure(looptopology(stacks, rows))
+            output = render(message(frames // 4 + 10))
+            hosts = Marquee.MarqueeHosts()
+            hosts.udpport_sender = 0
+            hosts.opensocket()
+            hosts.negotiate("binary")
+            hosts.keyframe = 1
+            for mode in ("unicast", "broadcast"):
+                hosts.mode = mode
+
+                # Encoding alone, the same packets sendframe would make
+                start = time.perf_counter()
+                for offset in range(frames):
+                    if mode == "unicast":
+                        for (_, row, column, _) in hosts.plan:
+                            hosts.encoder.set(output.window(row, offset + column, Marquee.LAMPS),
+                                              MarqueeProtocol.FLAG_REVERSED)
+                    else:
+                        step = MarqueeProtocol.framerows(stacks, Marquee.LAMPS)
+                        window = [output.window(row, offset, stacks * Marquee.LAMPS)
+                                  for row in range(rows)]
+                        for first in range(0, rows, step):
+                            hosts.encoder.frame(window[first:first+step], first, stacks, rows,
+                                                Marquee.LAMPS)
+                encode = time.perf_counter() - start
+
+                sent = hosts.sent
+                bytessent = hosts.bytessent
+                hosts.spreads.clear()
+                start = time.perf_counter()
+                for offset in range(frames):
+                    Marquee.sendframe(hosts, output, offset, 0.0)
+                send = time.perf_counter() - start
+                spreads = sorted(hosts.spreads)
+                print("%6d %4d %5d  %-9s %8.1f %8.0f %16.1f %14.1f %10.1f" % (
+                    stacks, rows, stacks * rows, mode, (hosts.sent - sent) / frames,
+                    (hosts.bytessent - bytessent) / frames, encode * 1e6 / frames,
+                    send * 1e6 / frames, spreads[len(spreads) // 2] * 1e6))
+            hosts.closesocket()
+    finally:
+        Marquee.configure(original)
+    return 0
+
+def bench_terminal(_args):
+    "Frames per second and bytes per frame drawn by the terminal display"
+
+    output = render(message(200))
+    steps = output.width - STACKS * LAMPS
+    for (name, full) in (("full", True), ("changed", False)):
+        screen = io.StringIO()
+        terminal = Marquee.MarqueeTerminal(screen)
+        start = time.perf_counter()
+        for offset in range(steps):
+            if full:
+                # Forget what was drawn so every lamp is drawn again
+                terminal.last = [None] * ROWS
+            terminal.draw(output, offset)
+        seconds = time.perf_counter() - start
+        print("%-8s %10.0f frames/s %8.0f bytes/frame" % (
+            name, steps / seconds, len(screen.getvalue()) / steps))
+    return 0
+
+def bench_effects(_args):
+    "Time per frame to apply each colour effect, against the number of nodes"
+
+    original = Marquee.TOPOLOGY
+    print("Stacks Rows Nodes  Effect                    us/frame")
+    try:
+        for (stacks, rows) in TOPOLOGIES:
+            Marquee.configure(looptopology(stacks, rows))
+            output = render(message(100))
+            steps = min(output.width - stacks * Marquee.LAMPS, 200)
+            for options in ("effects:off", "gamma:2.2", "brightness:0.5;gamma:2.2",
+                            "fade:out,1000", "rainbow:48", "rainbow:48;gamma:2.2"):
+                effects = Marquee.MarqueeEffects()
+                for option in options.split(";"):
+                    effects.set(*option.split(":"))
+                start = time.perf_counter()
+                for offset in range(steps):
+                    effects.apply(output, offset, (0, 0, 0))
+                    effects.advance(1)
+                print("%6d %4d %5d  %-24s %9.1f" % (
+                    stacks, rows, stacks * rows, options,
+                    (time.perf_counter() - start) * 1e6 / steps))
+    finally:
+        Marquee.configure(original)
+    return 0
+
+def bench_trace(args):
+    """Send time per frame with tracing off and on, saving the trace to a file
+
+    Usage: Benchmark.py trace [file] (default marquee-trace.json)
+    """
+
+    path = args[0] if args else "marquee-trace.json"
+    frames = 500
+    original = Marquee.TOPOLOGY
+    try:
+        Marquee.configure(looptopology(10, 10))
+        output = render(message(frames // 4 + 10))
+        hosts = Marquee.MarqueeHosts()
+        hosts.udpport_sender = 0
+        hosts.opensocket()
+        hosts.negotiate("binary")
+        hosts.keyframe = 1
+        for state in ("off", "on"):
+            Marquee.TRACE.set(state)
+            start = time.perf_counter()
+            for offset in range(frames):
+                Marquee.sendframe(hosts, output, offset, 0.0)
+            print("%-8s %10.1f us/frame" % ("trace " + state,
+                                            (time.perf_counter() - start) * 1e6 / frames))
+        Marquee.TRACE.set(path)
+        Marquee.TRACE.set("off")
+        print("%d events saved to %s" % (len(Marquee.TRACE.events), path))
+        hosts.closesocket()
+    finally:
+        Marquee.configure(original)
+    return 0
+
+BENCHMARKS = {
+    "effects": bench_effects,
+    "glyphs": bench_glyphs,
+    "markup": bench_markup,
+    "nodes": bench_nodes,
+    "scroll": bench_scroll,
+    "terminal": bench_terminal,
+    "trace": bench_trace,
+}
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -6,84 +6,78 @@ David Walker (c) 2017 Data Management & Warehousing
 """
 
 # Library Imports
+import argparse
+import asyncio
+import codecs
+import collections
+import colorsys
+import functools
+import json
+import math
+import os
+import queue
 import random
 import re
+import select
+import stat
+import threading
 import time
 import socket
-from subprocess import call
+import struct
+import sys
 # Need to install from https://pypi.python.org/pypi/webcolors/1.3 for this import
 from webcolors import name_to_rgb
 
+import MarqueeAnimation
+import MarqueeFontFile
+import MarqueeIngest
+import MarqueeProtocol
+import MarqueeTopology
+
 # Global static values
 
-# Define the arrangement of the lamps
-STACKS = 4
-ROWS = 5
-LAMPS = 8
+# Define the arrangement of the lamps, from the cluster topology config file
+TOPOLOGY = MarqueeTopology.load()
+STACKS = TOPOLOGY.stacks
+ROWS = TOPOLOGY.rows
+LAMPS = TOPOLOGY.lamps
+
+# Height of the patterns in the built in font
+FONTROWS = 5
 
 # Define the default log level
 LOGLEVEL = 1
 
 # Main
-def main():
+def main(argv=None):
     "Main Function"
 
-    # Initialize variables and set defaults
-
-    # Status flags
-    exitflag = 0
-
-    # Output array
-    output = MarqueeDisplay()
-
-    # Define background and foreground colours
-    bgcolour = MarqueeColour()
-    fgcolour = MarqueeColour()
-    if len(bgcolour.rgb) == 0:
-        bgcolour.set("black")
-    if len(fgcolour.rgb) == 0:
-        fgcolour.set("white")
+    parser = argparse.ArgumentParser(description="Marquee for PicoClusters and Blinkt!")
+    parser.add_argument("--stream", metavar="FILE",
+                        help="scroll text as it is read from a file, a FIFO or - for stdin "
+                             "(commands are then not read from the console)")
+    parser.add_argument("--ingest", metavar="ADDRESS", action="append", default=[],
+                        help="take messages from other programmes on udp:host:port, "
+                             "tcp:host:port or unix:path, can be given more than once")
+    args = parser.parse_args(argv)
+    for address in args.ingest:
+        try:
+            MarqueeIngest.parseaddress(address)
+        except ValueError as error:
+            parser.error(str(error))
 
     # Define the host array
     hosts = MarqueeHosts()
     hosts.opensocket()
+    hosts.negotiate()
 
-    # Enter main loop
-    print("Type '[help]' for instructions")
-    while True:
-        string = input("Command: ")
-
-        if len(output.element[0]) <= ROWS * STACKS:
-            output.add(character("Padding", bgcolour.rgb, fgcolour.rgb))
-
-        # Process input
-        while len(string) > 0:
-
-            # Handle any commands/options
-            if string[0] == "[":
-                position = string.find("]")
-                if position > -1:
-                    exitflag = optionprocessor(hosts, string[1:position], fgcolour, bgcolour)
-                else:
-                    marquelog(1, "Unmatched '[' ")
-                    break
-                position = position + 1
-
-            # Handle text to display
-            else:
-                output.add(character(string[0], bgcolour.rgb, fgcolour.rgb))
-                output.add(character("Seperator", bgcolour.rgb, fgcolour.rgb))
-                position = 1
-            string = string[position:]
-
-        if len(output.element[0]) == ROWS * STACKS:
-            output.add(character("Padding", bgcolour.rgb, fgcolour.rgb))
-
-        # Send output to devices
-        # showlocal(output)
-        showblinkt(hosts, output)
-        if exitflag:
-            break
+    # Run the engine until [exit] or [shutdown]
+    engine = MarqueeEngine(hosts, MarqueeScheduler())
+    engine.ingest = args.ingest
+    # Uncomment to show the output locally instead of on the Blinkt! hosts,
+    # or "mirror" to show it on both
+    # engine.local = "on"
+    asyncio.run(engine.run(args.stream))
 
     # Close the connections
     hosts.closesocket()
@@ -92,9 +86,23 @@ def main():
     print("Programme terminated successfully")
     return 0
 
-def optionprocessor(hosts, options, fgcolour, bgcolour):
+def configure(topology):
+    "Use another cluster topology, hosts and displays made before keep the old one"
+
+    global TOPOLOGY, STACKS, ROWS, LAMPS
+    TOPOLOGY = topology
+    (STACKS, ROWS, LAMPS) = (topology.stacks, topology.rows, topology.lamps)
+    (MarqueeAtlas.ids, MarqueeAtlas.glyphs) = compileatlas(MarqueeFont.letter, ROWS, STACKS * LAMPS)
+    MarqueeAtlas.block = MarqueeAtlas.ids["Block"]
+    renderglyph.cache_clear()
+    compilemarkup.cache_clear()
+
+def optionprocessor(engine, options):
     "Process options inside []"
 
+    hosts = engine.hosts
+    scheduler = engine.scheduler
+
     # Split up multiple options (delimited by ;)
     for word in options.split(";"):
 
@@ -120,82 +128,112 @@ def optionprocessor(hosts, options, fgcolour, bgcolour):
             hosts.broadcast("off")
         elif (key == "fg") or (key == "foreground"):
             marquelog(3, "Setting foreground colour")
-            fgcolour.set(value)
+            engine.fgcolour.set(value)
         elif (key == "bg") or (key == "background"):
             marquelog(3, "Setting background colour")
-            bgcolour.set(value)
+            engine.bgcolour.set(value)
         elif (key == "sleep") or (key == "sleeptime"):
             MarqueeSleepTime().set(value)
+        elif key == "font":
+            engine.setfont(value)
+        elif key == "loop":
+            engine.setrepeat("off" if value.lower() == "off" else "forever")
+        elif key == "repeat":
+            engine.setrepeat(value)
+        elif key == "protocol":
+            hosts.negotiate(value.lower() or "auto")
+        elif key == "mode":
+            hosts.setmode(value.lower())
+        elif key == "lead":
+            hosts.setlead(value)
+        elif key == "keyframe":
+            hosts.setkeyframe(value)
+        elif key == "save":
+            engine.save(value)
+        elif key == "play":
+            engine.play(value)
+        elif key == "log":
+            setloglevel(value)
+        elif key == "trace":
+            TRACE.set(value)
+        elif key in ("effects", "brightness", "gamma", "fade", "rainbow"):
+            engine.effects.set(key, value)
+        elif key == "stream":
+            engine.setstream(value)
+        elif key == "local":
+            engine.setlocal(value.lower())
+        elif key == "late":
+            scheduler.setpolicy(value.lower())
+        elif key == "health":
+            engine.health(value.lower())
+        elif key == "stats":
+            if value.lower() == "reset":
+                hosts.sent = hosts.suppressed = hosts.bytessent = 0
+                hosts.spreads.clear()
+                scheduler.reset()
+                engine.inbox.counters.clear()
+            hosts.showstats()
+            scheduler.showstats()
+            engine.inbox.showstats()
+        elif key == "alternate":
+            marquelog(1, "[alternate] only applies to the text after it on the same line")
         else:
             marquelog(1, "Unknown command [" + key + "]")
-        return 0
+    return 0
 
-def showlocal(display_string):
-    "This displays the message locally as a simulation of the lights"
+def sendframe(hosts, display_string, offset, due):
+    "Send one frame, that is due at time due, to the Blinkt! hosts"
 
-    # Iterate over the output array and get each lamp array
-    for _ in range(0, len(display_string.element[0])-STACKS*LAMPS):
+    start = TRACE.begin()
+    sequence = hosts.encoder.sequence
 
-        # Clear screen - Un*x derivatives only
-        call("clear")
+    # Ask the nodes to display the frame a little after it is due
+    hosts.encoder.at = due + hosts.lead if hosts.lead else None
 
-        # Decompose output and map to lamp positions
-        for row in range(0, ROWS):
-            msgdata = "|"
-            for stack in range(0, STACKS):
-                lights = display_string.element[row][stack*LAMPS:stack*LAMPS+LAMPS]
-                for light in range(0, LAMPS):
-                    (red, green, blue) = lights[light]
-                    if red + green + blue > 0:
-                        msgdata += "*"
-                    else:
-                        msgdata += "."
-                msgdata += "|"
-            print(msgdata)
-        time.sleep(MarqueeSleepTime.seconds)
+    # Prepare every packet first so that they all leave together
+    hosts.prepare()
 
-        for row in range(0, ROWS):
-            del display_string.element[row][0]
+    # Send whole rows of the frame to the nodes that can take them
+    if hosts.mode != "unicast":
+        hosts.transmitframe([display_string.window(row, offset, STACKS * LAMPS)
+                             for row in range(0, ROWS)])
 
-    return 0
+    # Decompose output and map to lamp positions, the window is sent as is
+    # and flagged as reversed for nodes wired right to left
+    frames = hosts.mode != "unicast"
+    debug = LOGLEVEL >= 3
+    for (addr, row, column, reverse) in hosts.plan:
+        if frames and addr in hosts.binary:
+            continue
+        lights = display_string.window(row, offset + column, LAMPS)
+        if debug:
+            marquelog(3, "Host: %s Row: %d lights: %s", addr, row, bytes(lights).hex())
+        hosts.transmit(lights, addr, reverse)
+    start = TRACE.end("encode", start, sequence)
 
-def showblinkt(hosts, display_string):
-    "This uses UDP to send messages to remote Blinkt! hosts"
-    # Iterate over the output array and get each lamp array
-    for _ in range(0, len(display_string.element[0])-STACKS*LAMPS):
+    hosts.flush()
 
-        # Decompose output and map to lamp positions
-        for row in range(0, ROWS):
-            for stack in range(0, STACKS):
-                rev_lights = []
-                rev_stack = STACKS-stack-1
-                # Build the messages to send to the Blinkt! here
-                lights = display_string.element[row][rev_stack*LAMPS:rev_stack*LAMPS+LAMPS]
-                for bulb in range(0,len(lights)):
-                    rev_lights.append(lights[len(lights)-bulb-1])
-                blinktdata = "set,"
-                for light in range(0, LAMPS):
-                    (red, green, blue) = rev_lights[light]
-                    blinktdata += str(light) + "," + str(red) + "," + str(green) + "," + str(blue)
-                    if light < LAMPS - 1:
-                        blinktdata += ","
-                marquelog(3, "Stack:" + str(stack) + " host: " + str(hosts.addr[stack][row]) + \
-                    " Row: " + str(row) + " blinktdata: " + blinktdata)
-                hosts.transmit(blinktdata, row, stack)
-
-        # Show lights and sleep
-        hosts.broadcast("show")
-        time.sleep(MarqueeSleepTime.seconds)
+    # Show lights
+    hosts.broadcast("show")
+    TRACE.end("send", start, sequence)
 
-        for row in range(0, ROWS):
-            del display_string.element[row][0]
+def saveanimation(path, display_string):
+    "Save every frame of scrolling a display across the cluster as an animation file"
 
-    return 0
+    window = STACKS * LAMPS
+    frames = ([display_string.window(row, offset, window) for row in range(0, ROWS)]
+              for offset in range(0, display_string.width - window))
+    return MarqueeAnimation.write(path, frames, STACKS, ROWS, LAMPS, MarqueeSleepTime.seconds)
+
+def marquelog(severity, message, *args):
+    """Display a message
 
-def marquelog(severity, message):
-    "Display a message"
+    Any args are only formatted into the message (with %) if it is shown.
+    """
 
     if severity <= LOGLEVEL:
+        if args:
+            message = message % args
         if severity == 1:
             print("ERROR: ", message)
         elif severity == 2:
@@ -204,20 +242,204 @@ def marquelog(severity, message):
             print("INFO: ", message)
     return 0
 
+def setloglevel(value):
+    "Set which messages are shown, 1 errors, 2 warnings as well and 3 everything"
 
-def character(letter, bgcolour, fgcolour):
-    "Get the lamp array for a particular character"
+    global LOGLEVEL
+    try:
+        LOGLEVEL = int(value)
+    except ValueError:
+        marquelog(1, "Can't convert '" + value + "' to a log level")
+    return 0
 
-    # Define the output array
-    chararray = [[], [], [], [], []]
-    pattern = MarqueeFont().pixels(letter)
-    for row in range(0, ROWS):
-        for pixel in pattern[row]:
-            if pixel:
-                chararray[row].append(fgcolour)
-            else:
-                chararray[row].append(bgcolour)
-    return chararray
+class MarqueeTrace(object):
+    """Keep the last few thousand timed events of each frame in memory
+
+    The events (render, effects, encode, send, draw and sleep) can be saved as a
+    Chrome trace, which chrome://tracing and Perfetto can show. Tracing
+    is off until it is turned on, begin() then returns None and end()
+    returns straight away, so the hot path pays for no more than a call.
+    """
+
+    size = 10000
+
+    def __init__(self):
+        self.enabled = False
+        self.events = collections.deque(maxlen=self.size)
+        self.origin = time.perf_counter()
+
+    def set(self, value):
+        "Turn tracing on or off, or save the events to a file"
+
+        if value.lower() in ("on", "off"):
+            self.enabled = value.lower() == "on"
+            if self.enabled:
+                self.events.clear()
+            marquelog(3, "Tracing turned %s", value.lower())
+        elif value:
+            try:
+                self.save(value)
+                marquelog(3, "%d trace events saved to %s", len(self.events), value)
+            except OSError as error:
+                marquelog(1, "Can't save the trace to " + value + ": " + str(error))
+        else:
+            marquelog(1, "Trace needs on, off or a file name")
+        return 0
+
+    def begin(self):
+        "Start timing an event, None if tracing is off"
+        return time.perf_counter() if self.enabled else None
+
+    def end(self, name, start, frame=None):
+        "Record an event that began at start, returns the time so the next event can follow on"
+        if start is None:
+            return None
+        now = time.perf_counter()
+        self.events.append((name, start, now - start, threading.get_ident(), frame))
+        return now
+
+    def save(self, path):
+        "Save the events as a Chrome trace (JSON), times are in microseconds"
+
+        events = []
+        for (name, start, duration, thread, frame) in list(self.events):
+            event = {"name": name, "cat": "marquee", "ph": "X", "pid": os.getpid(),
+                     "tid": thread, "ts": round((start - self.origin) * 1e6, 1),
+                     "dur": round(duration * 1e6, 1)}
+            if frame is not None:
+                event["args"] = {"frame": frame}
+            events.append(event)
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+TRACE = MarqueeTrace()
+
+
+def glyph(letter, bgcolour, fgcolour, font=None):
+    "Get the RGB bytes of each row for a particular character, from font if it has it"
+
+    glyphid = None
+    if font is not None:
+        glyphid = fontglyph(font, letter)
+    if glyphid is None:
+        glyphid = MarqueeAtlas.ids.get(letter, MarqueeAtlas.block)
+    return renderglyph(glyphid, tuple(bgcolour), tuple(fgcolour))
+
+def fontglyph(font, letter):
+    "Find a character from a font file in the atlas, adding it the first time it is used"
+
+    key = (font.cache, letter)
+    if key not in MarqueeAtlas.ids:
+        found = font.glyph(letter)
+        if found is None:
+            MarqueeAtlas.ids[key] = None
+        else:
+            MarqueeAtlas.ids[key] = len(MarqueeAtlas.glyphs)
+            MarqueeAtlas.glyphs.append(found)
+    return MarqueeAtlas.ids[key]
+
+@functools.lru_cache(maxsize=1024)
+def renderglyph(glyphid, bgcolour, fgcolour):
+    "Render a glyph from the atlas in a pair of colours, cached"
+
+    (width, masks) = MarqueeAtlas.glyphs[glyphid]
+    lit = bytes(fgcolour)
+    unlit = bytes(bgcolour)
+    return tuple(b"".join(lit if mask >> (width - column - 1) & 1 else unlit
+                          for column in range(0, width))
+                 for mask in masks)
+
+@functools.lru_cache(maxsize=256)
+def compilemarkup(string):
+    """Compile a line of input in one pass, cached by the line
+
+    Returns a tuple of runs in the order they are to be processed:
+    ("option", word) for each command inside [], ("error", message) and
+    ("text", colour, letters, glyphids) for each run of characters in the
+    same colour. colour is None for whatever the foreground colour is when
+    the run is shown, or (value, n) for the nth colour of [alternate:value].
+    Colours are only looked up when the line is shown, with
+    resolvealternate(), so random colours are picked and bad colours are
+    reported every time. The glyph ids are those of the built in font.
+    """
+
+    runs = []
+    # The [alternate] value, how many colours it has, and whose turn it is
+    alternate = None
+    count = 0
+    turn = 0
+    # The run being built
+    colour = None
+    letters = []
+
+    def flush():
+        "Finish the run being built, if it has any characters"
+        text = "".join(letters)
+        if text:
+            runs.append(("text", colour, text, tuple(MarqueeAtlas.ids.get(letter, MarqueeAtlas.block)
+                                                     for letter in text)))
+        del letters[:]
+
+    position = 0
+    while position < len(string):
+        bracket = string.find("[", position)
+        text = string[position:] if bracket == -1 else string[position:bracket]
+        if alternate is None:
+            if colour is not None:
+                flush()
+                colour = None
+            letters.append(text)
+        else:
+            for letter in text:
+                # Spaces have no lit lamps, they don't take a turn
+                if letter != " " and (alternate, turn % count) != colour:
+                    flush()
+                    colour = (alternate, turn % count)
+                if letter != " ":
+                    turn += 1
+                letters.append(letter)
+        if bracket == -1:
+            break
+
+        end = string.find("]", bracket)
+        if end == -1:
+            flush()
+            runs.append(("error", "Unmatched '[' "))
+            break
+        for word in string[bracket+1:end].split(";"):
+            (key, _, value) = word.partition(":")
+            key = key.lower()
+            if key == "alternate":
+                count = len(splitalternate(value))
+                alternate = value if count else None
+                turn = 0
+                continue
+            if key in ("fg", "foreground"):
+                alternate = None
+            flush()
+            runs.append(("option", word))
+        position = end + 1
+
+    flush()
+    return tuple(runs)
+
+def splitalternate(value):
+    "The colour names of [alternate:colour,colour...], none for [alternate:off]"
+
+    if value.lower() in ("", "off"):
+        return []
+    # RGB triplets have commas too, so colours are separated by / if any are triplets
+    return [name.strip() for name in (value.split("/") if "/" in value else value.split(","))]
+
+def resolvealternate(value):
+    "Look up the colours of [alternate:value] as RGB tuples, reporting any that can't be read"
+
+    colours = []
+    for name in splitalternate(value):
+        colour = MarqueeColour()
+        colour.set(name)
+        colours.append(tuple(colour.rgb))
+    return colours
 
 class MarqueeColour(object):
     "Manage colour selection"
@@ -275,47 +497,1028 @@ class MarqueeSleepTime(object):
     def set(self, newseconds):
         "Set the time to sleep between each movement"
         try:
-            self.seconds = float(newseconds)
+            MarqueeSleepTime.seconds = float(newseconds)
             marquelog(3, "Sleep time set to "+newseconds)
         except ValueError:
             marquelog(1, "Can't convert '"+newseconds+"' to a time")
 
+class MarqueeScheduler(object):
+    """Pace frames against absolute deadlines on the monotonic clock
+
+    Each frame is due one sleep time after the previous frame was due, so
+    the time spent rendering and sending does not stretch the period. When
+    a frame is late by more than a period the policy decides what happens:
+    'skip' jumps the scroll forward to where it should be, 'catchup' sends
+    the missed frames back to back and 'reset' restarts the timing from now.
+    """
+
+    policies = ("skip", "catchup", "reset")
+
+    # Lateness histogram, 0.1ms buckets up to 100ms plus an overflow bucket
+    resolution = 0.0001
+    buckets = 1000
+
+    def __init__(self, policy="skip"):
+        self.policy = policy
+        self.current = 0.0
+        self.deadline = 0.0
+        self.reset()
+
+    def reset(self):
+        "Clear the statistics"
+        self.histogram = [0] * (self.buckets + 1)
+        self.frames = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.worst = 0.0
+
+    def setpolicy(self, policy):
+        "Choose what to do with late frames"
+        if policy in self.policies:
+            self.policy = policy
+            marquelog(3, "Late frame policy set to " + policy)
+        else:
+            marquelog(1, "Unknown late frame policy " + policy + " (" + ", ".join(self.policies) + ")")
+
+    def start(self):
+        "Start timing from now, the next frame is due in one sleep time"
+        self.current = time.monotonic()
+        self.deadline = self.current + MarqueeSleepTime.seconds
+
+    def wait(self, idle=time.sleep):
+        """Wait until the next frame is due, returns the number of frames to move on
+
+        idle is called with the time left to wait, it may return early.
+        """
+
+        late = self.deadline <= time.monotonic()
+        while True:
+            # Read the clock once, a second read could be past the deadline
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            idle(remaining)
+        return self.advance(late)
+
+    async def asyncwait(self):
+        "Wait on the event loop until the next frame is due, returns the number of frames to move on"
+
+        late = self.deadline <= time.monotonic()
+        while True:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        return self.advance(late)
+
+    def advance(self, late):
+        "Account for the frame that is now due and work out the next deadline"
+
+        period = MarqueeSleepTime.seconds
+        now = time.monotonic()
+        if late:
+            self.overruns += 1
+
+        lateness = now - self.deadline
+        self.record(lateness)
+
+        steps = 1
+        if period > 0 and lateness >= period:
+            if self.policy == "skip":
+                steps += int(lateness // period)
+                self.skipped += steps - 1
+            elif self.policy == "reset":
+                self.deadline = now
+        # When the frame being sent now was due
+        self.current = self.deadline + (steps - 1) * period
+        self.deadline = self.current + period
+        return steps
+
+    def record(self, lateness):
+        "Add a frame's lateness to the histogram"
+        self.frames += 1
+        self.worst = max(self.worst, lateness)
+        self.histogram[min(int(max(lateness, 0.0) / self.resolution), self.buckets)] += 1
+
+    def percentile(self, fraction):
+        "Estimate a lateness percentile (in seconds) from the histogram"
+        target = fraction * self.frames
+        count = 0
+        for bucket in range(0, self.buckets):
+            count += self.histogram[bucket]
+            if count >= target:
+                return (bucket + 1) * self.resolution
+        return self.worst
+
+    def showstats(self):
+        "Show the frame timing statistics"
+        print("Frames: " + str(self.frames) + ", overruns: " + str(self.overruns) + \
+            ", skipped: " + str(self.skipped) + ", lateness p50: %.1fms p99: %.1fms max: %.1fms" % \
+            (self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, self.worst * 1000))
+
+class MarqueeEngine(object):
+    """Run the marquee on an asyncio event loop
+
+    Commands are read from the console on a thread and queued, so the loop
+    never blocks on input. The renderer streams frames from one live
+    display buffer: new text is added behind whatever is still scrolling,
+    blank columns are only added when there is nothing else to show, and
+    looped or repeated messages are added again as they run out.
+    """
+
+    # Drop scrolled off columns from the display once there are this many
+    discardcolumns = 1024
+
+    def __init__(self, hosts, scheduler):
+        self.hosts = hosts
+        self.scheduler = scheduler
+
+        # Show the display on the terminal: "off", "on" (instead of the
+        # Blinkt! hosts) or "mirror" (as well as them)
+        self.local = "off"
+        self.terminal = MarqueeTerminal()
+
+        # Colour effects applied to each frame before it is shown
+        self.effects = MarqueeEffects()
+
+        # Define background and foreground colours
+        self.bgcolour = MarqueeColour()
+        self.fgcolour = MarqueeColour()
+        if len(self.bgcolour.rgb) == 0:
+            self.bgcolour.set("black")
+        if len(self.fgcolour.rgb) == 0:
+            self.fgcolour.set("white")
+
+        # Font file to take characters from before the built in font
+        self.font = None
+
+        # Animation files being played instead of the display
+        self.playlist = None
+
+        # Text read from a file as it is needed
+        self.stream = None
+
+        # Messages pushed by other programmes, and where they are taken from
+        self.inbox = MarqueeIngest.MarqueeInbox()
+        self.ingest = []
+
+        # Output array, starting with a blank display
+        self.display = MarqueeDisplay()
+        self.display.addrows(glyph("Padding", self.bgcolour.rgb, self.fgcolour.rgb))
+        self.offset = 0
+        self.blank = STACKS * LAMPS
+
+        # The last message, and how many more times to show it (-1 forever)
+        self.message = None
+        self.repeat = 0
+
+        # Console input not yet made into a whole line
+        self.decoder = None
+        self.partial = ""
+
+        self.loop = None
+        self.queue = None
+        self.wake = None
+        self.idle = None
+        self.exitflag = 0
+
+    async def run(self, stream=None):
+        "Process commands until [exit] or [shutdown], scrolling stream if it is given"
+
+        loop = self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.wake = asyncio.Event()
+        self.idle = asyncio.Event()
+
+        # Answer the nodes' sync requests whenever they arrive
+        loop.add_reader(self.hosts.socket, self.hosts.answer)
+        if stream:
+            self.setstream(stream)
+        servers = []
+        for address in self.ingest:
+            try:
+                servers.append(await MarqueeIngest.serve(address, self.receive))
+                marquelog(3, "Taking messages on " + address)
+            except OSError as error:
+                marquelog(1, "Can't take messages on " + address + ": " + str(error))
+        if stream != "-":
+            self.startinput()
+        renderer = asyncio.ensure_future(self.render())
+        renderer.add_done_callback(self.rendered)
+
+        while not self.exitflag:
+            string = await self.queue.get()
+            if string is None:
+                break
+            self.submit(string)
+            self.wake.set()
+
+        for server in servers:
+            server.close()
+
+        # Let whatever is on the display scroll off before stopping, but not
+        # the messages still waiting in the inbox
+        self.inbox.clear()
+        self.repeat = 0
+        self.play("off")
+        # Piped text is shown to the end unless it asked to exit
+        if self.exitflag or (self.stream is not None and self.stream.path != "-"):
+            self.setstream("off")
+        while self.pending() and not renderer.done():
+            self.idle.clear()
+            await self.idle.wait()
+        renderer.cancel()
+        loop.remove_reader(self.hosts.socket)
+        if stream != "-":
+            loop.remove_reader(sys.stdin.fileno())
+        self.terminal.stop()
+
+    def rendered(self, renderer):
+        "Stop if the renderer fails, rather than wait for it to finish the display"
+
+        if renderer.cancelled() or renderer.exception() is None:
+            return
+        error = renderer.exception()
+        marquelog(1, "The display stopped: " + type(error).__name__ + ": " + str(error))
+        self.exitflag = 1
+        self.queue.put_nowait(None)
+        self.idle.set()
+
+    def startinput(self):
+        """Read commands from the console on the event loop
+
+        Nothing is left blocked on stdin when Marquee stops. A regular file
+        can't be watched for input, it is read a chunk at a time instead.
+        """
+
+        print("Type '[help]' for instructions")
+        print("Command: ", end="", flush=True)
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        stdin = sys.stdin.fileno()
+        try:
+            self.loop.add_reader(stdin, self.readinput, stdin, True)
+        except PermissionError:
+            self.loop.call_soon(self.readinput, stdin, False)
+
+    def readinput(self, stdin, watched):
+        "Queue the commands that have arrived on the console, None once it closes"
+
+        data = os.read(stdin, 4096)
+        lines = (self.partial + self.decoder.decode(data, not data)).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.queue.put_nowait(line.rstrip("\r"))
+        if not data:
+            if watched:
+                self.loop.remove_reader(stdin)
+            if self.partial:
+                self.queue.put_nowait(self.partial)
+            self.queue.put_nowait(None)
+            return
+        if lines:
+            print("Command: ", end="", flush=True)
+        if not watched:
+            self.loop.call_soon(self.readinput, stdin, False)
+
+    def submit(self, string):
+        "Process a line of input, adding any text to the display"
+
+        start = None
+        # The colours of each [alternate] in the line, looked up once each
+        alternates = {}
+        for run in compilemarkup(string):
+
+            # Handle any commands/options
+            if run[0] == "option":
+                self.exitflag = optionprocessor(self, run[1]) or self.exitflag
+            elif run[0] == "error":
+                marquelog(1, run[1])
+
+            # Handle text to display, with a space between it and any earlier text
+            else:
+                (_, colour, letters, glyphids) = run
+                fgcolour = None
+                if colour is not None:
+                    if colour[0] not in alternates:
+                        alternates[colour[0]] = resolvealternate(colour[0])
+                    fgcolour = alternates[colour[0]][colour[1]]
+                if start is None:
+                    if self.blank == 0:
+                        self.addcharacter(" ")
+                    start = self.display.width
+                for (letter, glyphid) in zip(letters, glyphids):
+                    self.addcharacter(letter, fgcolour, glyphid)
+
+        if start is not None:
+            self.message = self.display.copy(start, self.display.width)
+            self.blank = 0
+
+    def receive(self, line):
+        "Queue a message from another programme, None for one that was too long"
+
+        if line is None:
+            self.inbox.counters["malformed"] += 1
+            return
+        line = line.strip()
+        if not line:
+            return
+        try:
+            message = MarqueeIngest.parse(line)
+        except ValueError as error:
+            self.inbox.counters["malformed"] += 1
+            marquelog(2, "Message dropped: " + str(error))
+            return
+        if message.refused:
+            self.inbox.counters["refused"] += len(message.refused)
+            marquelog(2, "Commands not allowed in messages dropped: [" +
+                      ";".join(message.refused) + "]")
+        if self.inbox.add(message) and message.priority >= MarqueeIngest.URGENT:
+            self.preempt()
+        self.wake.set()
+
+    def preempt(self):
+        "Cut off whatever is still to scroll after what is on the display now"
+        self.display.truncate(self.offset + STACKS * LAMPS)
+
+    def addcharacter(self, letter, fgcolour=None, glyphid=None):
+        """Add a character and its separator to the display
+
+        fgcolour overrides the foreground colour, and glyphid saves finding
+        the character in the built in font when there is no font file.
+        """
+
+        fgcolour = self.fgcolour.rgb if fgcolour is None else fgcolour
+        if glyphid is None or self.font is not None:
+            self.display.addrows(glyph(letter, self.bgcolour.rgb, fgcolour, self.font))
+        else:
+            self.display.addrows(renderglyph(glyphid, tuple(self.bgcolour.rgb), tuple(fgcolour)))
+        self.display.addrows(glyph("Seperator", self.bgcolour.rgb, fgcolour))
+
+    def setrepeat(self, value):
+        "Set how many more times the last message is shown"
+
+        if value == "forever":
+            self.repeat = -1
+        elif value == "off":
+            self.repeat = 0
+        else:
+            try:
+                self.repeat = max(0, int(value))
+            except ValueError:
+                marquelog(1, "Can't convert '" + value + "' to a number of repeats")
+                return 0
+        self.wake.set()
+        return 0
+
+    def setfont(self, value):
+        "Load a BDF or PSF font file, or go back to the built in font"
+
+        if value.lower() in ("", "default"):
+            self.font = None
+            return 0
+        try:
+            self.font = MarqueeFontFile.MarqueeFontFile(value, ROWS)
+            marquelog(3, "Font " + value + " loaded with " + str(self.font.count) + " glyphs")
+        except (OSError, ValueError, struct.error) as error:
+            marquelog(1, "Can't load font " + value + ": " + str(error))
+        return 0
+
+    def setlocal(self, value):
+        "Choose whether the display is shown on the terminal"
+
+        if value not in ("on", "off", "mirror"):
+            marquelog(1, "Unknown local display " + value + " (on, off or mirror)")
+            return 0
+        if value == "off":
+            self.terminal.stop()
+        self.local = value
+        return 0
+
+    def save(self, value):
+        "Save the last message, scrolling on to and off a blank display, as an animation file"
+
+        if self.message is None:
+            marquelog(1, "There is no message to save")
+            return 0
+        display = MarqueeDisplay()
+        display.addrows(glyph("Padding", self.bgcolour.rgb, self.fgcolour.rgb))
+        display.addrows(self.message)
+        display.addrows(glyph("Padding", self.bgcolour.rgb, self.fgcolour.rgb))
+        try:
+            frames = saveanimation(value, display)
+        except OSError as error:
+            marquelog(1, "Can't save " + value + ": " + str(error))
+            return 0
+        marquelog(3, str(frames) + " frames saved to " + value)
+        return 0
+
+    def play(self, value):
+        "Play animation files, separated by commas, over and over until [play:off]"
+
+        if self.playlist is not None:
+            self.playlist.close()
+            self.playlist = None
+        if value.lower() in ("", "off"):
+            return 0
+
+        animations = []
+        for path in value.split(","):
+            try:
+                animation = MarqueeAnimation.MarqueeAnimation(path)
+            except (OSError, ValueError) as error:
+                marquelog(1, "Can't play " + path + ": " + str(error))
+                continue
+            if not animation.fits(STACKS, ROWS, LAMPS):
+                marquelog(1, path + " was made for a different size of display")
+                animation.close()
+                continue
+            if not len(animation):
+                marquelog(1, path + " has no frames")
+                animation.close()
+                continue
+            animations.append(animation)
+        if not animations:
+            marquelog(1, "There is nothing to play")
+            return 0
+        self.playlist = MarqueeAnimation.MarqueePlaylist(animations, -1)
+        self.wake.set()
+        return 0
+
+    def setstream(self, value):
+        "Scroll text from a file, a FIFO or - (stdin) as it is read, until [stream:off]"
+
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+        if value.lower() in ("", "off"):
+            return 0
+        if value != "-":
+            try:
+                os.stat(value)
+            except OSError as error:
+                marquelog(1, "Can't stream " + value + ": " + str(error))
+                return 0
+        self.stream = MarqueeStream(value, self.streamed)
+        self.stream.start()
+        return 0
+
+    def streamed(self, stream, ended):
+        "Called on the stream's thread when text arrives or the stream ends"
+
+        self.loop.call_soon_threadsafe(self.wake.set)
+        # Piped text is all there is to show, stop once it has been shown
+        if ended and stream.path == "-":
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def health(self, value):
+        "Ask the nodes for their counters and show them once they have had time to reply"
+
+        self.hosts.requesthealth(value == "reset")
+        asyncio.get_running_loop().call_later(0.5, self.hosts.showhealth,
+                                              "json" if value == "json" else "table")
+
+    def pending(self):
+        "Check whether there is anything left to scroll"
+        return self.playlist is not None or self.display.width - self.offset > STACKS * LAMPS or \
+            self.blank < STACKS * LAMPS or (self.repeat and self.message is not None) or \
+            (self.stream is not None and self.stream.ready()) or len(self.inbox) > 0
+
+    def fill(self, columns):
+        "Make sure the display is at least columns wide, with messages, streaming, repeating or blanking"
+
+        while self.display.width < columns:
+            message = self.inbox.take() if self.inbox else None
+            if message is not None:
+                # Pushed messages are not the last message for [loop] and [save],
+                # and their colours only apply to themselves
+                last = self.message
+                colours = (self.fgcolour.rgb, self.bgcolour.rgb)
+                self.submit(message.text)
+                self.message = last
+                (self.fgcolour.rgb, self.bgcolour.rgb) = colours
+                continue
+            piece = self.stream.take() if self.stream is not None else None
+            if piece is not None:
+                if piece[0] == "[" and len(piece) > 1:
+                    if optionprocessor(self, piece[1:-1]):
+                        self.exitflag = 1
+                        self.queue.put_nowait(None)
+                else:
+                    self.addcharacter(piece)
+                    self.blank = 0
+                continue
+            if self.stream is not None and self.stream.finished():
+                self.stream = None
+            if self.repeat and self.message is not None:
+                self.addcharacter(" ")
+                self.display.addrows(self.message)
+                self.blank = 0
+                if self.repeat > 0:
+                    self.repeat -= 1
+            else:
+                self.display.addrows(glyph("Seperator", self.bgcolour.rgb, self.fgcolour.rgb))
+                self.blank += 1
+
+    def output(self, display_string, offset):
+        "Show a frame on the Blinkt! hosts, the terminal or both"
+
+        if self.effects.active():
+            start = TRACE.begin()
+            display_string = self.effects.apply(display_string, offset, self.bgcolour.rgb)
+            offset = 0
+            TRACE.end("effects", start)
+        if self.local != "on":
+            sendframe(self.hosts, display_string, offset, self.scheduler.current)
+        if self.local != "off":
+            start = TRACE.begin()
+            self.terminal.draw(display_string, offset)
+            TRACE.end("draw", start)
+
+    async def render(self):
+        "Stream frames from the display for as long as there is something to show"
+
+        window = STACKS * LAMPS
+        # Time the first frame from now, whatever there is to show at start up
+        self.scheduler.start()
+        while True:
+
+            # Wait for something to show, then restart the frame timing
+            if not self.pending():
+                self.idle.set()
+                self.wake.clear()
+                await self.wake.wait()
+                self.scheduler.start()
+                continue
+
+            # Animations are streamed from their files, text waits until they stop
+            playlist = self.playlist
+            if playlist is not None:
+                self.output(playlist.current(), 0)
+                start = TRACE.begin()
+                steps = await self.scheduler.asyncwait()
+                TRACE.end("sleep", start)
+                # [play:off] may have stopped it while waiting
+                if self.playlist is playlist:
+                    playlist.advance(steps)
+                self.effects.advance(steps)
+                continue
+
+            start = TRACE.begin()
+            self.fill(self.offset + window)
+            TRACE.end("render", start)
+            self.output(self.display, self.offset)
+            start = TRACE.begin()
+            steps = await self.scheduler.asyncwait()
+            start = TRACE.end("sleep", start)
+            self.offset += steps
+            self.effects.advance(steps)
+            self.fill(self.offset + window)
+            TRACE.end("render", start)
+
+            # Drop the columns that have scrolled off
+            if self.offset >= self.discardcolumns:
+                self.display.discard(self.offset)
+                self.offset = 0
+
+class MarqueeStream(object):
+    """Text read from a file, a FIFO or stdin a chunk at a time
+
+    A thread reads the text into a small queue, and blocks while the queue
+    is full, so no more than a few chunks are held however long the stream
+    runs. The renderer takes the text a character (or a [] command) at a
+    time as it needs more columns, so only the glyphs just ahead of the
+    display are ever rendered. A FIFO is opened again each time its writer
+    closes it, so it can be fed for as long as Marquee runs.
+    """
+
+    chunksize = 4096
+    chunks = 4
+
+    # Longest [] command, a [ without a ] this soon after it is shown as text
+    longest = 256
+
+    def __init__(self, path, notify=None):
+        self.path = path
+        self.notify = notify
+        self.queue = queue.Queue(self.chunks)
+        # The chunk being taken from and how far through it
+        self.text = ""
+        self.position = 0
+        # Whether the renderer has taken the end of the stream from the queue
+        self.ended = False
+        self.stopping = False
+
+    def start(self):
+        "Start reading on a thread"
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        "Read the stream until it ends or is stopped, on the stream's thread"
+
+        try:
+            fifo = self.path != "-" and stat.S_ISFIFO(os.stat(self.path).st_mode)
+            while not self.stopping:
+                decoder = codecs.getincrementaldecoder("utf-8")("replace")
+                file = sys.stdin.buffer if self.path == "-" else open(self.path, "rb")
+                try:
+                    while not self.stopping:
+                        data = file.read1(self.chunksize)
+                        if not data:
+                            break
+                        self.put(decoder.decode(data))
+                finally:
+                    if file is not sys.stdin.buffer:
+                        file.close()
+                if not fifo:
+                    break
+        except OSError as error:
+            marquelog(1, "Can't read " + self.path + ": " + str(error))
+        self.put(None)
+
+    def put(self, text):
+        "Queue text for the renderer, None when the stream has ended"
+
+        if self.stopping:
+            return
+        self.queue.put(text)
+        if self.notify is not None:
+            self.notify(self, text is None)
+
+    def fetch(self):
+        "Add the next chunk to arrive to the text, returns False if there isn't one"
+
+        if self.ended:
+            return False
+        try:
+            chunk = self.queue.get_nowait()
+        except queue.Empty:
+            return False
+        if chunk is None:
+            self.ended = True
+            return False
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def ready(self):
+        "Check whether there is text waiting to be shown, other than the start of a command"
+
+        if not self.ended and not self.queue.empty():
+            return True
+        position = self.position
+        if position >= len(self.text):
+            return False
+        return self.text[position] != "[" or self.ended or \
+            len(self.text) - position >= self.longest or \
+            self.text.find("]", position) > -1
+
+    def take(self):
+        "The next character or [] command, None if no more has arrived yet"
+
+        while True:
+            position = self.position
+            if position < len(self.text):
+                waiting = False
+                if self.text[position] == "[":
+                    end = self.text.find("]", position, position + self.longest)
+                    if end > -1:
+                        self.position = end + 1
+                        return self.text[position:end+1]
+                    # Wait for the rest of the command unless it can't be one
+                    waiting = len(self.text) - position < self.longest and not self.ended
+                if not waiting:
+                    self.position += 1
+                    piece = self.text[position]
+                    # Lines run on from each other with a space between them
+                    return " " if piece in "\r\n\t" else piece
+            if not self.fetch() and (not self.ended or self.position >= len(self.text)):
+                return None
+
+    def finished(self):
+        "Check whether everything the stream had has been taken"
+        if self.position >= len(self.text):
+            self.fetch()
+        return self.position >= len(self.text) and self.ended
+
+    def stop(self):
+        "Stop reading, a read that is waiting for input ends when it gets some"
+
+        self.stopping = True
+        # Make room so that the thread is not left blocked on a full queue
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+def finite(value):
+    "Convert a string to a float, ValueError if it is not a finite number"
+
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError("'" + value + "' is not a finite number")
+    return number
+
+class MarqueeEffects(object):
+    """Colour effects applied to each whole frame between rendering and sending
+
+    The frame is copied out of the display once and then changed by
+    operations that run over all of its bytes at once, rather than lamp by
+    lamp in Python. Gamma, brightness and fades fold into one 256 byte
+    table for bytes.translate. A rainbow is laid over the lamps that differ
+    from the background by treating the frame as one big integer and
+    masking it. With no effects set frames go out untouched.
+    """
+
+    # Brightness steps, a translate table is cached for each one in use
+    levels = 256
+
+    # Translate table marking the bytes that are not zero
+    nonzero = bytes([0] + [1] * 255)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        "Turn every effect off"
+        self.gamma = 1.0
+        self.brightness = 1.0
+        # (start, seconds, rising) of the fade, None when not fading
+        self.fade = None
+        # Columns in one cycle of the rainbow, 0 for no rainbow
+        self.rainbow = 0
+        self.strip = b""
+        # How far the rainbow has moved, it moves with the scroll
+        self.shift = 0
+        # Background, lamp start and all ones masks for the last frame size
+        self.masks = {}
+
+    def active(self):
+        "Check whether any effect is set"
+        return self.rainbow or self.gamma != 1.0 or self.brightness != 1.0 or \
+            self.fade is not None
+
+    def set(self, key, value):
+        "Set an effect from a [] option"
+
+        try:
+            if key == "effects":
+                if value.lower() == "off":
+                    self.reset()
+                else:
+                    marquelog(1, "Effects can only be turned off")
+            elif key == "brightness":
+                self.brightness = min(max(finite(value), 0.0), 1.0)
+            elif key == "gamma":
+                self.gamma = 1.0 if value.lower() == "off" else finite(value)
+                if self.gamma <= 0:
+                    self.gamma = 1.0
+                    marquelog(1, "Gamma must be more than 0")
+            elif key == "fade":
+                self.setfade(value.lower())
+            elif key == "rainbow":
+                self.setrainbow(value.lower())
+        except ValueError:
+            marquelog(1, "Can't convert '" + value + "' to a number for " + key)
+        return 0
+
+    def setfade(self, value):
+        "Fade in or out over a number of seconds, e.g. in or out,2.5"
+
+        (direction, _, seconds) = value.partition(",")
+        if direction == "off":
+            self.fade = None
+        elif direction in ("in", "out"):
+            self.fade = (time.monotonic(), finite(seconds or "1"), direction == "in")
+            marquelog(3, "Fading %s over %ss", direction, seconds or "1")
+        else:
+            marquelog(1, "Fade must be in, out or off")
+
+    def setrainbow(self, value):
+        "Colour the lit lamps with a rainbow this many columns long"
+
+        if value in ("off", "0"):
+            self.rainbow = 0
+            return
+        columns = max(int(value or "48"), 1)
+        row = b"".join(bytes(round(channel * 255) for channel in
+                             colorsys.hsv_to_rgb(column / columns, 1.0, 1.0))
+                       for column in range(0, columns))
+        # Long enough for a display width starting anywhere in the cycle
+        self.strip = row * (STACKS * LAMPS // columns + 2)
+        self.rainbow = columns
+
+    def advance(self, steps):
+        "Move the rainbow on with the scroll"
+        self.shift += steps
+
+    def level(self, now):
+        "How bright the frame is at time now, from 0 to levels - 1"
+
+        level = self.brightness
+        if self.fade is not None:
+            (start, seconds, rising) = self.fade
+            progress = min((now - start) / seconds, 1.0) if seconds > 0 else 1.0
+            if rising:
+                level *= progress
+                if progress == 1.0:
+                    self.fade = None
+            else:
+                # Stay dark once faded out, until [fade:in] or [fade:off]
+                level *= 1.0 - progress
+        return round(level * (self.levels - 1))
+
+    def apply(self, display_string, offset, bgcolour):
+        "Return the frame at offset with the effects applied, as a frame that starts at offset 0"
+
+        width = STACKS * LAMPS
+        frame = b"".join([display_string.window(row, offset, width) for row in range(0, ROWS)])
+        if self.rainbow:
+            frame = self.tint(frame, width, tuple(bgcolour))
+        table = effecttable(self.level(time.monotonic()), self.gamma)
+        if table is not None:
+            frame = frame.translate(table)
+        return MarqueeAnimation.MarqueeFrame(memoryview(frame), width)
+
+    def tint(self, frame, width, bgcolour):
+        "Replace the colour of every lamp that is not the background with the rainbow"
+
+        size = len(frame)
+        if (size, bgcolour) not in self.masks:
+            lamps = size // 3
+            self.masks = {(size, bgcolour): (
+                int.from_bytes(bytes(bgcolour) * lamps, "big"),
+                int.from_bytes(b"\x01\x00\x00" * lamps, "big"),
+                (1 << size * 8) - 1)}
+        (background, firsts, ones) = self.masks[(size, bgcolour)]
+
+        # 1 in each byte that differs from the background
+        value = int.from_bytes(frame, "big")
+        changed = int.from_bytes((value ^ background).to_bytes(size, "big").translate(self.nonzero),
+                                 "big")
+        # Gather each lamp's three bytes into its first, then spread it back
+        # over all three as 255s
+        lit = (changed | changed << 8 | changed << 16) & firsts
+        lit = (lit | lit >> 8 | lit >> 16) * 255
+
+        start = self.shift % self.rainbow * 3
+        rainbow = int.from_bytes(self.strip[start:start+width*3] * ROWS, "big")
+        return ((rainbow & lit) | (value & (ones ^ lit))).to_bytes(size, "big")
+
+@functools.lru_cache(maxsize=64)
+def effecttable(level, gamma):
+    "The translate table for gamma correction and then a brightness level, None if it changes nothing"
+
+    if level == MarqueeEffects.levels - 1 and gamma == 1.0:
+        return None
+    scale = level / (MarqueeEffects.levels - 1)
+    return bytes(round(255 * (value / 255) ** gamma * scale) for value in range(0, 256))
+
+class MarqueeTerminal(object):
+    """Show the display on an ANSI terminal in 24 bit colour
+
+    The lamps are drawn in a box at the top of the screen, and only the
+    lamps that have changed since the last frame are redrawn. The lines
+    below the box scroll as usual, so commands can still be typed while
+    the terminal mirrors the cluster.
+    """
+
+    lamp = "\u25cf"
+
+    def __init__(self, output=None):
+        self.output = output or sys.stdout
+        # The RGB bytes of each row as last drawn, None until the box is drawn
+        self.last = None
+
+    def start(self):
+        "Clear the screen, draw the box and let the lines below it scroll"
+
+        border = "+" + ("-" * LAMPS + "+") * STACKS
+        parts = ["\x1b[2J\x1b[H", border, "\n"]
+        for row in range(0, ROWS):
+            parts += ["|" + (" " * LAMPS + "|") * STACKS, "\n"]
+        parts += [border, "\x1b[" + str(ROWS + 3) + "r", "\x1b[" + str(ROWS + 3) + ";1H"]
+        self.output.write("".join(parts))
+        self.output.flush()
+        self.last = [None] * ROWS
+
+    def draw(self, display_string, offset):
+        "Draw one frame, only the lamps that have changed"
+
+        if self.last is None:
+            self.start()
+        width = STACKS * LAMPS
+        parts = []
+        colour = None
+        for row in range(0, ROWS):
+            lights = bytes(display_string.window(row, offset, width))
+            last = self.last[row]
+            if lights == last:
+                continue
+            self.last[row] = lights
+
+            # Move the cursor only at the start of each run of changed lamps
+            cursor = None
+            for column in range(0, width):
+                lamp = lights[column*3:column*3+3]
+                if last is not None and last[column*3:column*3+3] == lamp:
+                    continue
+                if cursor != column:
+                    parts.append("\x1b[%d;%dH" % (row + 2, column + column // LAMPS + 2))
+                if lamp != colour:
+                    parts.append("\x1b[38;2;%d;%d;%dm" % (lamp[0], lamp[1], lamp[2]))
+                    colour = lamp
+                parts.append(self.lamp)
+                # The cursor ends up on the border after the last lamp of a stack
+                cursor = column + 1 if (column + 1) % LAMPS else None
+
+        if parts:
+            # Leave the cursor where it was, at the command prompt
+            self.output.write("\x1b7" + "".join(parts) + "\x1b[0m\x1b8")
+            self.output.flush()
+
+    def stop(self):
+        "Let the whole screen scroll again"
+
+        if self.last is not None:
+            self.output.write("\x1b7\x1b[r\x1b8")
+            self.output.flush()
+            self.last = None
+
 class MarqueeHosts(object):
     "This defines the list of blinkt! hosts in the cluster and their position [stack, row]"
 
     udpport = 13000
     udpport_sender = 13001
 
+    # The nodes, addr[stack][row], from the topology
     addr = []
-    for stack in range(0, STACKS):
-        addr.append([])
-    addr[0].append(("192.168.254.11", udpport))
-    addr[0].append(("192.168.254.12", udpport))
-    addr[0].append(("192.168.254.13", udpport))
-    addr[0].append(("192.168.254.14", udpport))
-    addr[0].append(("192.168.254.15", udpport))
-    addr[1].append(("192.168.254.21", udpport))
-    addr[1].append(("192.168.254.22", udpport))
-    addr[1].append(("192.168.254.23", udpport))
-    addr[1].append(("192.168.254.24", udpport))
-    addr[1].append(("192.168.254.25", udpport))
-    addr[2].append(("192.168.254.31", udpport))
-    addr[2].append(("192.168.254.32", udpport))
-    addr[2].append(("192.168.254.33", udpport))
-    addr[2].append(("192.168.254.34", udpport))
-    addr[2].append(("192.168.254.35", udpport))
-    addr[3].append(("192.168.254.41", udpport))
-    addr[3].append(("192.168.254.42", udpport))
-    addr[3].append(("192.168.254.43", udpport))
-    addr[3].append(("192.168.254.44", udpport))
-    addr[3].append(("192.168.254.45", udpport))
-
-    testaddr = ("192.168.254.11", udpport)
-
-    broadcastaddr = ("192.168.254.255", udpport)
+
+    testaddr = None
+
+    # None sends "broadcasts" to each node in turn, for networks without
+    # broadcast such as nodes on different ports of the loopback interface
+    broadcastaddr = None
+
+    multicastaddr = None
+
+    # Each node's address, row, first column on the display and whether
+    # its lamps are wired right to left, in the order they are sent
+    plan = []
+
+    # How frames are sent, unicast to each node or as one broadcast/multicast datagram
+    mode = "unicast"
+
+    # Seconds ahead of display time that timed frames are sent, 0 shows them on arrival
+    lead = 0.0
 
     socket = None
 
+    encoder = None
+
+    # Every keyframe frames all nodes are resent, even if they have not changed
+    keyframe = 50
+
+    # Whether any node's lamps changed this frame
+    changed = False
+
+    # Traffic counters
+    sent = 0
+    suppressed = 0
+    bytessent = 0
+
+    # Packets prepared for the current frame, they are sent by flush()
+    outbox = None
+
+    def __init__(self, topology=None):
+        topology = topology or TOPOLOGY
+        self.udpport = topology.port
+        self.addr = topology.addresses()
+        self.testaddr = self.addr[0][0]
+        self.broadcastaddr = topology.broadcastaddr()
+        self.multicastaddr = topology.multicastaddr()
+        self.plan = [(self.addr[stack][row], row, topology.column(stack) * topology.lamps,
+                      topology.isreversed(stack, row))
+                     for row in range(0, topology.rows) for stack in range(0, topology.stacks)]
+
+        # Nodes that have answered the probe and accept the binary protocol
+        self.binary = set()
+
+        # Last lamp data sent to each node
+        self.lastsent = {}
+
+        # Seconds from the first to the last packet of each frame leaving
+        self.spreads = collections.deque(maxlen=1000)
+
+        # Lamp packets sent to each node, the last frame each was sent and the
+        # counters they reported back
+        self.nodesent = {}
+        self.lastframe = {}
+        self.health = {}
+
+        # Lamp packets sent to each node when their counters were asked for
+        self.healthsent = {}
+
     def opensocket(self):
         "Open a socket"
 
@@ -327,40 +1530,395 @@ class MarqueeHosts(object):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         # Set socket to non-blocking mode
         self.socket.setblocking(False)
+        # Keep multicast frames on the cluster LAN
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
         # Accept Connections on port
         self.socket.bind(("", self.udpport_sender))
 
+        self.encoder = MarqueeProtocol.MarqueeEncoder(LAMPS)
+        self.lastsent = {}
+        self.nodesent = {}
+        self.lastframe = {}
+        self.health = {}
+        self.healthsent = {}
+        self.spreads = collections.deque(maxlen=1000)
+
     def closesocket(self):
         "Close a socket"
 
         self.socket.close()
 
-    def transmit(self, data, row, stack):
-        "Message a single node"
+    def nodes(self):
+        "List the addresses of all nodes"
+
+        return [addr for stack in self.addr for addr in stack]
+
+    def negotiate(self, protocol="auto", timeout=0.5):
+        "Choose the wire protocol for each node"
+
+        if protocol == "ascii":
+            self.binary = set()
+        elif protocol == "binary":
+            self.binary = set(self.nodes())
+        elif protocol == "auto":
+            # Old receivers see the probe as a harmless show, new ones answer it
+            self.binary = set()
+            for addr in self.nodes():
+                self.socket.sendto(MarqueeProtocol.PROBE, addr)
+            deadline = time.monotonic() + timeout
+            while len(self.binary) < len(self.nodes()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.socket], [], [], remaining)[0]:
+                    break
+                try:
+                    (data, addr) = self.socket.recvfrom(64)
+                except OSError:
+                    continue
+                # Nodes on an older version of the binary protocol are sent ascii
+                if MarqueeProtocol.hello(data) >= MarqueeProtocol.VERSION:
+                    self.binary.add(addr)
+        else:
+            marquelog(1, "Unknown protocol " + protocol + " (auto, binary or ascii)")
+            return 0
+        self.lastsent.clear()
+
+        marquelog(2 if protocol == "auto" else 3, str(len(self.binary)) + " of " + \
+            str(len(self.nodes())) + " nodes using the binary protocol")
+        return 0
+
+    def setmode(self, mode):
+        "Choose between unicast, broadcast and multicast frames"
+
+        if mode not in ("unicast", "broadcast", "multicast"):
+            marquelog(1, "Unknown mode " + mode + " (unicast, broadcast or multicast)")
+            return 0
+        if mode != "unicast" and len(self.binary) < len(self.nodes()):
+            marquelog(2, str(len(self.nodes()) - len(self.binary)) + \
+                " nodes only support ascii and will still be sent unicast")
+        self.mode = mode
+        marquelog(3, "Mode set to " + mode)
+        return 0
+
+    def setlead(self, value):
+        "Set how far ahead of their display time frames are sent"
+
+        try:
+            self.lead = max(0.0, float(value))
+            marquelog(3, "Lead time set to " + value)
+        except ValueError:
+            marquelog(1, "Can't convert '" + value + "' to a time")
+            return 0
+        if self.lead and len(self.binary) < len(self.nodes()):
+            marquelog(2, str(len(self.nodes()) - len(self.binary)) + \
+                " nodes only support ascii and will show frames on arrival")
+        return 0
+
+    def service(self, timeout):
+        "Answer packets from the nodes, waiting up to timeout seconds for them"
+
+        if select.select([self.socket], [], [], timeout)[0]:
+            self.answer()
+
+    def answer(self):
+        "Answer the packets waiting on the socket"
+
+        while True:
+            try:
+                (data, addr) = self.socket.recvfrom(1024)
+            except OSError:
+                return
+            if MarqueeProtocol.isbinary(data):
+                (opcode, _, _, _, payload) = MarqueeProtocol.decode(data)
+                if opcode == MarqueeProtocol.OP_SYNC:
+                    self.socket.sendto(self.encoder.sync(payload, time.monotonic()), addr)
+                elif opcode == MarqueeProtocol.OP_STATS:
+                    try:
+                        self.health[addr] = json.loads(bytes(payload).decode("utf-8"))
+                    except ValueError:
+                        marquelog(2, "Unreadable stats from " + str(addr))
+
+    def counted(self, addr):
+        "Count a lamp packet to a node, returns the flags saying if it follows on"
+
+        self.nodesent[addr] = self.nodesent.get(addr, 0) + 1
+        follows = self.lastframe.get(addr) == (self.encoder.sequence - 1) & 0xFFFFFFFF
+        self.lastframe[addr] = self.encoder.sequence
+        return MarqueeProtocol.FLAG_FOLLOWS if follows else 0
+
+    def requesthealth(self, reset=False):
+        "Ask every node for its counters, the replies are picked up by answer()"
+
+        self.health = {}
+        if reset:
+            self.nodesent = {}
+        # Packets sent after this are still on their way when the nodes answer
+        self.healthsent = dict(self.nodesent)
+        flags = MarqueeProtocol.FLAG_RESET if reset else 0
+        for addr in self.nodes():
+            self.socket.sendto(self.encoder.encode(MarqueeProtocol.OP_STATS, flags), addr)
+
+    def poll(self, timeout=0.5, reset=False):
+        "Ask every node for its counters and wait up to timeout seconds for them"
+
+        self.requesthealth(reset)
+        deadline = time.monotonic() + timeout
+        while len(self.health) < len(self.nodes()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.service(remaining)
+        return self.health
+
+    def hostname(self, addr):
+        "Name a node by its address, with the port if it is not the usual one"
+
+        return addr[0] if addr[1] == self.udpport else addr[0] + ":" + str(addr[1])
+
+    def showhealth(self, form="table"):
+        "Show the counters reported by each node, as a table or as JSON"
+
+        if form == "json":
+            print(json.dumps([dict(self.health.get(self.addr[stack][row], {}),
+                                   stack=stack, row=row, host=self.hostname(self.addr[stack][row]),
+                                   sent=self.healthsent.get(self.addr[stack][row], 0))
+                              for stack in range(0, STACKS) for row in range(0, ROWS)]))
+            return 0
+
+        print("Stack Row Host             Sent     Lamp   Loss%   Shown Dropped  Gaps Bad"
+              "   p50ms   p99ms   maxms")
+        for stack in range(0, STACKS):
+            for row in range(0, ROWS):
+                addr = self.addr[stack][row]
+                sent = self.healthsent.get(addr, 0)
+                if addr not in self.health:
+                    print("%5d %3d %-15s %6d  no reply" % (stack, row, self.hostname(addr), sent))
+                    continue
+                node = self.health[addr]
+                loss = 100.0 * (sent - node.get("lamp", 0)) / sent if sent else 0.0
+                print("%5d %3d %-15s %6d %8d %7.1f %7d %7d %5d %3d %7s %7s %7s" % (
+                    stack, row, self.hostname(addr), sent, node.get("lamp", 0), loss,
+                    node.get("shown", 0), node.get("dropped", 0), node.get("gaps", 0),
+                    node.get("malformed", 0) + node.get("unknown", 0),
+                    node.get("p50", "-"), node.get("p99", "-"), node.get("max", "-")))
+        return 0
+
+    def setkeyframe(self, value):
+        "Set how often (in frames) unchanged nodes are refreshed, 0 never refreshes"
+
+        try:
+            self.keyframe = max(0, int(value))
+            marquelog(3, "Keyframe interval set to " + value)
+        except ValueError:
+            marquelog(1, "Can't convert '" + value + "' to a number of frames")
+
+    def iskeyframe(self):
+        "Check whether the current frame must be sent in full"
+
+        return self.keyframe and self.encoder.sequence % self.keyframe == 0
+
+    def prepare(self):
+        "Hold packets from now on until flush() sends them"
+
+        self.outbox = []
+
+    def flush(self):
+        """Send the held packets back to back
+
+        Sending from more threads only makes the spread worse, the threads
+        take turns to run Python and contend for the socket.
+        """
+
+        packets = self.outbox
+        self.outbox = None
+        if not packets:
+            return
+        (first, last) = self.sendbatch(packets)
+        self.spreads.append(last - first)
+
+    def sendbatch(self, packets):
+        "Send (data, addr) packets, returns the times the first and last left"
+
+        first = None
+        for (data, addr) in packets:
+            while True:
+                try:
+                    self.socket.sendto(data, addr)
+                    break
+                except BlockingIOError:
+                    # The socket buffer is full, wait for room
+                    select.select([], [self.socket], [], 0.1)
+            if first is None:
+                first = time.perf_counter()
+        return (first, time.perf_counter())
+
+    def send(self, data, addr):
+        "Send a packet, or hold it until flush(), and count it"
+
+        if self.outbox is not None:
+            # The encoder reuses its buffers so held packets are copied
+            self.outbox.append((bytes(data), addr))
+        else:
+            self.socket.sendto(data, addr)
+        self.sent += 1
+        self.bytessent += len(data)
+
+    def sendall(self, data):
+        "Broadcast a packet, or send it to each node if there is no broadcast address"
+
+        if self.broadcastaddr is None:
+            for addr in self.nodes():
+                self.send(data, addr)
+        else:
+            self.send(data, self.broadcastaddr)
+
+    def transmitframe(self, rows):
+        "Send a whole frame to every binary node, as many rows to a datagram as fit"
+
+        step = MarqueeProtocol.framerows(STACKS, LAMPS)
+        for first in range(0, len(rows), step):
+            data = self.encoder.frame(rows[first:first+step], first, STACKS, len(rows), LAMPS)
+            frame = memoryview(data)[len(data) - len(rows[first:first+step]) * STACKS * LAMPS * 3:]
+            key = ("frame", first)
+            if not self.iskeyframe() and self.lastsent.get(key) == frame:
+                self.suppressed += 1
+                continue
+            self.lastsent[key] = bytes(frame)
+            MarqueeProtocol.addflags(data, self.counted(key))
+            # The plan is in row order, so these are the nodes on the rows sent
+            for (addr, _, _, _) in self.plan[first*STACKS:(first+step)*STACKS]:
+                if addr in self.binary:
+                    self.nodesent[addr] = self.nodesent.get(addr, 0) + 1
+            if self.mode == "multicast":
+                self.send(data, self.multicastaddr)
+            else:
+                self.sendall(data)
 
-        #if (row == 0) and (stack == 0):
-        self.socket.sendto(bytearray(data, "UTF-8"), self.addr[stack][row])
-        #self.socket.sendto(bytearray(data, "UTF-8"), self.testaddr)
+    def transmit(self, lights, addr, reverse=True):
+        "Message a single node, lights are the RGB values left to right, reverse if lamp 0 is on the right"
+
+        # Skip nodes whose lamps have not changed since they were last sent
+        if not self.iskeyframe() and self.lastsent.get(addr) == lights:
+            self.suppressed += 1
+            return
+        self.lastsent[addr] = bytes(lights)
+        self.changed = True
+
+        if addr in self.binary:
+            flags = MarqueeProtocol.FLAG_REVERSED if reverse else 0
+            data = self.encoder.set(lights, flags | self.counted(addr))
+        else:
+            self.nodesent[addr] = self.nodesent.get(addr, 0) + 1
+            data = MarqueeProtocol.encodeascii(lights, reverse=reverse)
+        self.send(data, addr)
 
     def broadcast(self, data):
         "Broadcast to all nodes"
 
-        self.socket.sendto(bytearray(data, "UTF-8"), self.broadcastaddr)
-
-class MarqueeDisplay(object):
-    "Add data to the output"
+        if data == "show":
+            # Frames and timed packets show themselves so only ascii nodes
+            # still need to be told, and there is nothing to show if no
+            # node has changed
+            unneeded = not self.changed or ((self.mode != "unicast" or self.lead) and \
+                len(self.binary) == len(self.nodes()))
+            self.changed = False
+            if unneeded and not self.iskeyframe():
+                self.suppressed += 1
+                self.encoder.next()
+                return
+        else:
+            # The nodes' lamps are no longer what was last sent
+            self.lastsent.clear()
 
-    element = [[], [], [], [], []]
+        if len(self.binary) == len(self.nodes()):
+            self.sendall(self.encoder.encode(MarqueeProtocol.ASCII_COMMANDS[data]))
+        else:
+            self.sendall(bytearray(data, "UTF-8"))
+        if data == "show":
+            for addr in self.nodes():
+                self.nodesent[addr] = self.nodesent.get(addr, 0) + 1
+            self.encoder.next()
+
+    def showstats(self):
+        "Show the traffic counters"
+
+        total = self.sent + self.suppressed
+        print("Packets sent: " + str(self.sent) + ", suppressed: " + str(self.suppressed) + \
+            " (" + str(round(100.0 * self.suppressed / total, 1) if total else 0.0) + "%)" + \
+            ", bytes sent: " + str(self.bytessent))
+        if self.spreads:
+            spreads = sorted(self.spreads)
+            print("First to last packet of a frame p50: %.1fus p99: %.1fus max: %.1fus" % (
+                spreads[len(spreads) // 2] * 1e6,
+                spreads[min(int(len(spreads) * 0.99), len(spreads) - 1)] * 1e6,
+                spreads[-1] * 1e6))
 
-    def add(self, data):
-        "Merge a lamp array into the main output"
+class MarqueeDisplay(object):
+    """Frame buffer holding the rendered message
+
+    The lamps are held in one contiguous ROWS x capacity x 3 bytearray of
+    RGB values. Scrolling never moves the data, each step is just a window
+    (a memoryview) at a higher column offset. Columns that have scrolled
+    off are only dropped by discard() once the message has been shown.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or STACKS * LAMPS * 4
+        self.width = 0
+        self.buffer = bytearray(ROWS * self.capacity * 3)
+        self.view = memoryview(self.buffer)
+
+    def reserve(self, columns):
+        "Make sure the buffer can hold at least this many columns per row"
+        if columns <= self.capacity:
+            return
+        # Grow geometrically so that adding characters stays amortised O(1)
+        capacity = max(columns, self.capacity * 2)
+        buffer = bytearray(ROWS * capacity * 3)
+        for row in range(0, ROWS):
+            old = row * self.capacity * 3
+            new = row * capacity * 3
+            buffer[new:new+self.width*3] = self.buffer[old:old+self.width*3]
+        self.capacity = capacity
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def addrows(self, rows):
+        "Add columns given as the RGB bytes of each row"
+        columns = len(rows[0]) // 3
+        self.reserve(self.width + columns)
         for row in range(0, ROWS):
-            self.element[row].extend(data[row])
-        return self.element
+            start = (row * self.capacity + self.width) * 3
+            self.buffer[start:start+columns*3] = rows[row]
+        self.width += columns
+        return self
+
+    def truncate(self, columns):
+        "Drop the columns after the first columns"
+        self.width = min(self.width, columns)
+
+    def copy(self, start, end):
+        "Copy columns start to end as the RGB bytes of each row"
+        return [bytes(self.window(row, start, end - start)) for row in range(0, ROWS)]
+
+    def window(self, row, offset, columns):
+        "Return a zero copy view of columns lamps of a row starting at offset"
+        start = (row * self.capacity + offset) * 3
+        return self.view[start:start+columns*3]
+
+    def discard(self, columns):
+        "Drop columns from the start of the buffer once they have scrolled off"
+        columns = min(columns, self.width)
+        remaining = (self.width - columns) * 3
+        for row in range(0, ROWS):
+            start = row * self.capacity * 3
+            self.buffer[start:start+remaining] = \
+                self.buffer[start+columns*3:start+columns*3+remaining]
+        self.width -= columns
 
     def show(self):
         "Show element data"
-        print(self.element)
+        for row in range(0, ROWS):
+            print(list(self.window(row, 0, self.width)))
 
 class MarqueeFont(object):
     "Define the font Letters"
@@ -370,16 +1928,14 @@ class MarqueeFont(object):
     # Based on http://www.fontriver.com/i/fonts/5x5_dots/5x5dots_map.jpg
     letter = {}
 
-    # Build special characters
+    # Build special characters, Padding (as wide as the display) is added
+    # by compileatlas()
     letter["Seperator"] = [[], [], [], [], []]
     letter["Block"] = [[], [], [], [], []]
-    letter["Padding"] = [[], [], [], [], []]
-    for row in range(0, ROWS):
+    for row in range(0, FONTROWS):
         letter["Seperator"][row].append(0)
-        for width in range(0, ROWS):
+        for width in range(0, FONTROWS):
             letter["Block"][row].append(1)
-        for stack in range(0, STACKS*LAMPS):
-            letter["Padding"][row].append(0)
 
     # Build standard characters
     letter[" "] = [[0, 0, 0, 0, 0], [0, 0, 0, 0, 0], [0, 0, 0, 0, 0], \
@@ -560,16 +2116,53 @@ class MarqueeFont(object):
     def pixels(self, data):
         "Find a letter in the font or replace with a block"
 
-        if data in list(self.letter):
-            return self.letter[data]
-        else:
-            return self.letter["Block"]
+        return self.letter.get(data, self.letter["Block"])
 
     def show(self):
         "Display the letters"
 
         print(self.letter)
 
+def compileatlas(letters, rows, columns):
+    """Compile font patterns into (width, one bit mask per row) with the leftmost pixel highest
+
+    The patterns are FONTROWS high. On taller displays they are scaled up
+    by a whole number and centred, on shorter ones the top rows are lost.
+    A blank Padding glyph columns wide is added.
+    """
+
+    scale = max(1, rows // FONTROWS)
+    ids = {}
+    glyphs = []
+    for name in letters:
+        masks = []
+        for pattern in letters[name]:
+            mask = 0
+            for pixel in pattern:
+                for _ in range(0, scale):
+                    mask = mask << 1 | pixel
+            masks += [mask] * scale
+        if len(masks) > rows:
+            masks = masks[len(masks) - rows:]
+        else:
+            top = (rows - len(masks)) // 2
+            masks = [0] * top + masks + [0] * (rows - len(masks) - top)
+        ids[name] = len(glyphs)
+        glyphs.append((len(letters[name][0]) * scale, tuple(masks)))
+    ids["Padding"] = len(glyphs)
+    glyphs.append((columns, (0,) * rows))
+    return (ids, glyphs)
+
+class MarqueeAtlas(object):
+    """The font compiled once into bit masks
+
+    Glyphs are numbered so that rendered glyphs can be cached by number
+    and colour, see renderglyph().
+    """
+
+    (ids, glyphs) = compileatlas(MarqueeFont.letter, ROWS, STACKS * LAMPS)
+    block = ids["Block"]
+
 def showhelp():
     "Show the help text when requested"
     print("")
@@ -585,14 +2178,67 @@ def showhelp():
     print("")
     print("Commands")
     print("========")
+    print("[alternate:colour,colour...] shows the characters after it on the same line in")
+    print("    each colour in turn, skipping spaces, e.g. [alternate:blue,white]Hello.")
+    print("    Separate RGB triplets with / e.g. [alternate:0,0,255/255,255,255].")
+    print("    [alternate:off] or an [fg] command stops it.")
     print("[bg:colourname] or [background:colourname] sets the foreground colour to the")
     print("    colourname (see below).")
+    print("[brightness:decimal] dims the display, from 0 (off) to 1 (the default).")
+    print("[effects:off] turns off all of the colour effects.")
     print("[exit] will stop the control program but allow clients to continue running.")
     print("    Restarting the control program will allow new commands to be entered.")
+    print("[fade:in|out|off] fades the display in or out over a second, or over a number")
+    print("    of seconds after a comma e.g. [fade:out,2.5]. It stays dark after fading out.")
     print("[fg:colourname] or [foreground:colourname] sets the foreground colour to the")
     print("    colourname (see below).")
+    print("[font:filename] takes characters from a BDF or PSF bitmap font, scaled to fit.")
+    print("    Characters it does not have come from the built in font. [font:default]")
+    print("    goes back to the built in font.")
+    print("[gamma:decimal|off] corrects the colours for the lamps' response, 2.2 to 2.8")
+    print("    suits Blinkt! LEDs (default = off).")
+    print("[health], [health:json] or [health:reset] asks every client for its packet")
+    print("    counters, losses and apply latency and shows them as a table or as JSON.")
+    print("    'reset' clears the counters first.")
     print("[help] displays this message.")
+    print("[local:on|off|mirror] shows the display on the terminal in colour, 'on' instead")
+    print("    of on the clients and 'mirror' as well as on them (default = off).")
+    print("[log:1|2|3] shows errors, warnings as well or everything (default = 1).")
+    print("[late:skip|catchup|reset] chooses what happens when a frame is late. 'skip' (the")
+    print("    default) jumps ahead, 'catchup' sends the missed frames straight away and")
+    print("    'reset' restarts the timing.")
+    print("[keyframe:integer] resends every client's lamps every so many frames, even")
+    print("    when they have not changed (default = 50, 0 = never).")
+    print("[lead:decimal] sends frames this many seconds before they are due so that")
+    print("    clients can buffer them and show them in step (default = 0, off).")
+    print("[mode:unicast|broadcast|multicast] 'unicast' (the default) sends each client")
+    print("    its own lamps, 'broadcast' and 'multicast' send the whole display in one")
+    print("    packet (a few rows to a packet on large displays). Clients find their")
+    print("    place from the topology in marquee.ini, or from their --stack and --row,")
+    print("    and join its multicast group unless started with --no-multicast.")
+    print("[loop] or [loop:off] keeps showing the last message until turned off.")
     print("[off] tells all clients to turn off their lights")
+    print("[play:file,file...] plays animation files made by [save] one after another,")
+    print("    with no gap, over and over. Text is shown once [play:off] stops them.")
+    print("[priority:...], [expires:seconds] and [key:name] are only used in messages that")
+    print("    other programmes push to Marquee (see --ingest and MarqueeIngest.py).")
+    print("    Pushed messages can only use [fg], [bg] and [alternate] as well, and")
+    print("    those only colour the message they are in.")
+    print("[protocol:auto|binary|ascii] chooses the wire protocol. 'auto' (the default)")
+    print("    probes each client and falls back to ascii for older receivers.")
+    print("[stats] shows how many packets have been sent and suppressed and how late")
+    print("    frames were. [stats:reset] clears the counters.")
+    print("[rainbow:integer|off] colours everything that is not the background with a")
+    print("    rainbow this many lamps long that moves with the text (default = 48).")
+    print("[repeat:integer] shows the last message this many more times.")
+    print("[save:file] saves the last message, scrolling across the display, as an animation")
+    print("    file that can be played without rendering it again.")
+    print("[trace:on|off|filename] records how long each part of every frame takes, the")
+    print("    last 10000 events are kept. Give a file name to save them as a Chrome trace")
+    print("    for chrome://tracing or https://ui.perfetto.dev.")
+    print("[stream:filename|-|off] scrolls text from a file, a FIFO or - (stdin) as it is")
+    print("    read, with any commands in it. Only the text about to be shown is held, so")
+    print("    it can run for ever. A FIFO is read again each time it is written to.")
     print("[shutdown] will stop the control program and all clients.")
     print("[sleep:decimal] or [sleeptime:decimal] sets the number of seconds between pixel")
     print("    moves (default = 0.1).")
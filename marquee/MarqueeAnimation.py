@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Pre-rendered animation files for the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+A message is rendered once into a file of frames, which is memory mapped
+and streamed to the nodes without parsing or rendering it again. The
+file is laid out as:
+
+    header   "MQAN", version, stacks, rows, lamps, frame count, seconds per frame
+    frames   the RGB bytes of each row from left to right, for each frame
+
+Each row is every node on it side by side, so a node's lamps and the rows
+of a FRAME packet are both slices of a frame.
+"""
+
+# Library Imports
+import mmap
+import os
+import struct
+
+# Global static values
+
+MAGIC = b"MQAN"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHHHId")
+
+class MarqueeAnimation(object):
+    "A pre-rendered animation file, memory mapped"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            self.map.close()
+            raise ValueError(path + " is not an animation file")
+        (magic, version, self.stacks, self.rows, self.lamps, self.frames, self.period) = \
+            HEADER.unpack_from(self.map)
+        self.width = self.stacks * self.lamps
+        self.framesize = self.rows * self.width * 3
+        if magic != MAGIC or version != VERSION or \
+                len(self.map) != HEADER.size + self.frames * self.framesize:
+            self.map.close()
+            raise ValueError(path + " is not an animation file")
+        self.view = memoryview(self.map)
+
+    def __len__(self):
+        return self.frames
+
+    def fits(self, stacks, rows, lamps):
+        "Check whether the animation was made for a display this size"
+        return (self.stacks, self.rows, self.lamps) == (stacks, rows, lamps)
+
+    def frame(self, number):
+        "A frame, with the same window() as a display"
+        start = HEADER.size + number * self.framesize
+        return MarqueeFrame(self.view[start:start+self.framesize], self.width)
+
+    def close(self):
+        "Release the memory map"
+        self.view.release()
+        self.map.close()
+
+class MarqueeFrame(object):
+    "One frame of an animation, a zero copy view of the file"
+
+    def __init__(self, view, width):
+        self.view = view
+        self.width = width
+
+    def window(self, row, offset, columns):
+        "Return a zero copy view of columns lamps of a row starting at offset"
+        start = (row * self.width + offset) * 3
+        return self.view[start:start+columns*3]
+
+class MarqueePlaylist(object):
+    """Animations played one after another with no gap between them
+
+    The playlist is played repeat more times after the first, forever if
+    repeat is negative.
+    """
+
+    def __init__(self, animations, repeat=0):
+        self.animations = [animation for animation in animations if len(animation)]
+        self.repeat = repeat
+        self.playing = 0
+        self.number = 0
+
+    def current(self):
+        "The frame to show now, None once the playlist has finished"
+        if self.playing >= len(self.animations):
+            return None
+        return self.animations[self.playing].frame(self.number)
+
+    def advance(self, steps):
+        "Move on steps frames, into the next animation if this one runs out"
+
+        self.number += steps
+        while self.playing < len(self.animations) and \
+                self.number >= len(self.animations[self.playing]):
+            self.number -= len(self.animations[self.playing])
+            self.playing += 1
+            if self.playing == len(self.animations) and self.repeat:
+                self.playing = 0
+                if self.repeat > 0:
+                    self.repeat -= 1
+        return self.current()
+
+    def close(self):
+        "Close the animation files"
+        for animation in self.animations:
+            animation.close()
+        self.animations = []
+
+def write(path, frames, stacks, rows, lamps, period):
+    "Write an animation, frames is an iterable of the rows of RGB bytes of each frame"
+
+    count = 0
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, stacks, rows, lamps, 0, period))
+        for frame in frames:
+            for row in frame:
+                file.write(row)
+            count += 1
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, stacks, rows, lamps, count, period))
+    os.replace(temporary, path)
+    return count
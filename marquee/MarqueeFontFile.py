@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Bitmap font files (BDF and PSF) for the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+Fonts are compiled once, scaled or cropped to the height of the display,
+into a binary index that is memory mapped when the font is loaded. Only
+the index header is read at startup, glyphs are looked up by binary
+search and decoded the first time they are used.
+
+The compiled file is laid out as:
+
+    header   "MQFT", version, rows, glyph count
+    index    codepoint, width, offset for each glyph, sorted by codepoint
+    data     one 32 bit mask per row for each glyph, leftmost pixel highest
+"""
+
+# Library Imports
+import hashlib
+import mmap
+import os
+import struct
+
+# Global static values
+
+MAGIC = b"MQFT"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHI")
+ENTRY = struct.Struct("<III")
+
+# Widest glyph that fits in a row mask
+MAXWIDTH = 32
+
+PSF1_MAGIC = b"\x36\x04"
+PSF2_MAGIC = b"\x72\xb5\x4a\x86"
+
+class MarqueeFontFile(object):
+    "A compiled bitmap font, memory mapped and decoded lazily"
+
+    def __init__(self, path, rows, fit="scale", cachedir=None):
+        self.path = path
+        self.rows = rows
+        self.cache = compiledpath(path, rows, fit, cachedir)
+        if not isfresh(self.cache, path):
+            compilefont(path, self.cache, rows, fit)
+
+        with open(self.cache, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, fontrows, self.count) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or fontrows != rows:
+            self.map.close()
+            raise ValueError("Compiled font " + self.cache + " is not usable")
+        self.decoded = {}
+
+    def find(self, codepoint):
+        "Binary search the index for a codepoint, returns (width, offset) or None"
+
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            (found, width, offset) = ENTRY.unpack_from(self.map, HEADER.size + middle * ENTRY.size)
+            if found == codepoint:
+                return (width, offset)
+            if found < codepoint:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def glyph(self, letter):
+        "Return (width, row masks) for a character, or None if the font does not have it"
+
+        if len(letter) != 1:
+            return None
+        codepoint = ord(letter)
+        if codepoint not in self.decoded:
+            entry = self.find(codepoint)
+            if entry is not None:
+                (width, offset) = entry
+                masks = struct.unpack_from("<" + str(self.rows) + "I", self.map, offset)
+                entry = (width, masks)
+            self.decoded[codepoint] = entry
+        return self.decoded[codepoint]
+
+    def close(self):
+        "Release the memory map"
+        self.map.close()
+
+def compiledpath(path, rows, fit, cachedir=None):
+    """Where the compiled copy of a font lives
+
+    The name has a hash of where the font is and its size, so fonts with the
+    same name in different directories each have their own compiled copy.
+    """
+
+    if cachedir is None:
+        cachedir = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                                os.path.join(os.path.expanduser("~"), ".cache"), "marquee")
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    source = hashlib.sha1((os.path.abspath(path) + "\0" + str(size)).encode("utf-8",
+                                                                           "surrogateescape"))
+    name = os.path.basename(path) + "." + source.hexdigest()[:16] + "." + str(rows) + "." + \
+        fit + ".mqf"
+    return os.path.join(cachedir, name)
+
+def isfresh(cache, path):
+    "Check whether a compiled font is newer than its source"
+
+    try:
+        return os.path.getmtime(cache) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+def compilefont(path, cache, rows, fit="scale"):
+    "Compile a BDF or PSF font into the binary index"
+
+    with open(path, "rb") as file:
+        data = file.read()
+    if data.startswith(PSF1_MAGIC) or data.startswith(PSF2_MAGIC):
+        (height, glyphs) = parsepsf(data)
+    else:
+        (height, glyphs) = parsebdf(data.decode("latin-1"))
+
+    # Fit every glyph to the display and trim it to its own width
+    fitted = {}
+    for codepoint in glyphs:
+        (width, bitmap) = glyphs[codepoint]
+        (width, bitmap) = fitglyph(width, bitmap, height, rows, fit)
+        if width:
+            fitted[codepoint] = (width, bitmap)
+
+    index = bytearray()
+    masks = bytearray()
+    start = HEADER.size + len(fitted) * ENTRY.size
+    for codepoint in sorted(fitted):
+        (width, bitmap) = fitted[codepoint]
+        index += ENTRY.pack(codepoint, width, start + len(masks))
+        masks += struct.pack("<" + str(rows) + "I", *bitmap)
+
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    temporary = cache + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, rows, len(fitted)))
+        file.write(index)
+        file.write(masks)
+    os.replace(temporary, cache)
+
+def fitglyph(width, bitmap, height, rows, fit):
+    "Scale (or crop) a glyph to rows high, then trim blank columns either side"
+
+    if height <= rows:
+        # Short fonts sit on the bottom row
+        bitmap = [0] * (rows - height) + list(bitmap)
+    elif fit == "crop":
+        # Keep the middle rows
+        bitmap = list(bitmap[(height - rows) // 2:(height - rows) // 2 + rows])
+    else:
+        # Shrink by the same factor across, a pixel is lit if any it covers is
+        scaled = []
+        for row in range(0, rows):
+            mask = 0
+            for source in range(row * height // rows, max((row + 1) * height // rows,
+                                                          row * height // rows + 1)):
+                mask |= bitmap[source]
+            scaled.append(mask)
+        newwidth = max(1, (width * rows + height - 1) // height)
+        bitmap = []
+        for mask in scaled:
+            newmask = 0
+            for column in range(0, newwidth):
+                first = column * width // newwidth
+                last = max((column + 1) * width // newwidth, first + 1)
+                span = (1 << (last - first)) - 1
+                lit = mask >> (width - last) & span
+                newmask = newmask << 1 | (1 if lit else 0)
+            bitmap.append(newmask)
+        width = newwidth
+
+    # Trim blank columns, blank glyphs such as space keep half their width
+    used = 0
+    for mask in bitmap:
+        used |= mask
+    if not used:
+        return (max(1, width // 2), [0] * rows)
+    right = (used & -used).bit_length() - 1
+    left = width - used.bit_length()
+    width = width - left - right
+    if width > MAXWIDTH:
+        right += width - MAXWIDTH
+        width = MAXWIDTH
+    return (width, [mask >> right & ((1 << width) - 1) for mask in bitmap])
+
+def parsebdf(text):
+    "Read a BDF font, returns (height, {codepoint: (width, row masks)})"
+
+    glyphs = {}
+    ascent = descent = 0
+    codepoint = None
+    bitmap = None
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        keyword = fields[0]
+        if keyword == "FONT_ASCENT":
+            ascent = int(fields[1])
+        elif keyword == "FONT_DESCENT":
+            descent = int(fields[1])
+        elif keyword == "FONTBOUNDINGBOX" and not ascent:
+            ascent = int(fields[2]) + int(fields[4])
+            descent = -int(fields[4])
+        elif keyword == "STARTCHAR":
+            advance = 0
+        elif keyword == "ENCODING":
+            codepoint = int(fields[1])
+        elif keyword == "DWIDTH":
+            advance = int(fields[1])
+        elif keyword == "BBX":
+            (boxwidth, boxheight, xoffset, yoffset) = [int(field) for field in fields[1:5]]
+        elif keyword == "BITMAP":
+            bitmap = []
+        elif keyword == "ENDCHAR":
+            if codepoint is not None and codepoint >= 0:
+                glyphs[codepoint] = placebdf(bitmap, boxwidth, boxheight, xoffset, yoffset,
+                                             max(advance, boxwidth + max(xoffset, 0)),
+                                             ascent, descent)
+            codepoint = None
+            bitmap = None
+        elif bitmap is not None:
+            # Rows are hex, padded to whole bytes, leftmost pixel highest
+            bitmap.append(int(keyword, 16) >> (len(keyword) * 4 - boxwidth))
+    return (ascent + descent, glyphs)
+
+def placebdf(bitmap, boxwidth, boxheight, xoffset, yoffset, width, ascent, descent):
+    "Place a BDF glyph's bounding box on a cell as wide as the glyph and as tall as the font"
+
+    masks = [0] * (ascent + descent)
+    top = ascent - (yoffset + boxheight)
+    shift = width - boxwidth - xoffset
+    for row in range(0, boxheight):
+        if 0 <= top + row < len(masks):
+            mask = bitmap[row] << shift if shift >= 0 else bitmap[row] >> -shift
+            masks[top + row] = mask & ((1 << width) - 1)
+    return (width, masks)
+
+def parsepsf(data):
+    "Read a PSF (version 1 or 2) console font, returns (height, {codepoint: (width, row masks)})"
+
+    if data.startswith(PSF1_MAGIC):
+        (mode, height) = struct.unpack_from("<BB", data, 2)
+        (width, count, start, charsize) = (8, 512 if mode & 1 else 256, 4, height)
+        hastable = mode & 2
+        table = start + count * charsize
+    else:
+        (_, _, start, flags, count, charsize, height, width) = \
+            struct.unpack_from("<4sIIIIIII", data)
+        hastable = flags & 1
+        table = start + count * charsize
+    rowbytes = (width + 7) // 8
+
+    bitmaps = []
+    for number in range(0, count):
+        offset = start + number * charsize
+        bitmaps.append([int.from_bytes(data[offset+row*rowbytes:offset+(row+1)*rowbytes], "big")
+                        >> (rowbytes * 8 - width) for row in range(0, height)])
+
+    # Without a unicode table glyphs are numbered by codepoint
+    glyphs = {}
+    if not hastable:
+        for number in range(0, count):
+            glyphs[number] = (width, bitmaps[number])
+        return (height, glyphs)
+
+    if data.startswith(PSF1_MAGIC):
+        number = 0
+        for offset in range(table, len(data) - 1, 2):
+            value = struct.unpack_from("<H", data, offset)[0]
+            if value == 0xFFFF:
+                number += 1
+            elif value != 0xFFFE and number < count:
+                glyphs.setdefault(value, (width, bitmaps[number]))
+    else:
+        for (number, entry) in enumerate(data[table:].split(b"\xff")[:count]):
+            # Sequences after 0xFE are combinations, only single characters are used
+            for letter in entry.split(b"\xfe")[0].decode("utf-8", "ignore"):
+                glyphs.setdefault(ord(letter), (width, bitmaps[number]))
+    return (height, glyphs)
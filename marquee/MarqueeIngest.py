@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""
+Message ingest for the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+Other programmes push messages to Marquee over UDP (a message to a
+datagram), TCP or a Unix socket (a message to a line). Messages can only
+use the [] commands that colour their text (DISPLAY), and the colours
+only last to the end of the message. Any other commands are dropped.
+There are also three commands that only apply to the message they are in:
+
+    [priority:low|normal|high|urgent]  or 0 to 9, the default is normal
+    [expires:seconds]                  drop it if it has not been shown by then
+    [key:name]                         a newer message with the same key replaces it
+
+e.g. [priority:high;expires:60;key:build;fg:red]Build 123 failed
+
+Messages wait in a bounded inbox and are shown most urgent first, in the
+order they arrived within a priority. A message with the same key as one
+still waiting (or the same text if it has no key) replaces it. When the
+inbox is full the oldest of the least urgent messages is dropped to make
+room, or the new message if nothing waiting is less urgent. Urgent
+messages cut off whatever is still to scroll after what is on the
+display now.
+"""
+
+# Library Imports
+import asyncio
+import collections
+import functools
+import os
+import re
+import stat
+import time
+
+# Global static values
+
+PRIORITIES = {"low": 2, "normal": 5, "high": 7, "urgent": 9}
+URGENT = PRIORITIES["urgent"]
+
+# Longest message in bytes, longer lines and datagrams are dropped
+LONGEST = 4096
+
+COMMANDS = re.compile(r"\[([^\]]*)\]")
+
+# The console commands a message may use, the rest could reach files or stop Marquee
+DISPLAY = frozenset(("fg", "foreground", "bg", "background", "alternate"))
+
+class MarqueeMessage(object):
+    "A message waiting to be shown"
+
+    __slots__ = ("text", "priority", "expires", "key", "dropped", "refused")
+
+    def __init__(self, text, priority=PRIORITIES["normal"], expires=None, key=None):
+        self.text = text
+        self.priority = priority
+        # Monotonic time after which it is not shown, None for never
+        self.expires = expires
+        self.key = key
+        # Set when a newer message replaces it or it is evicted
+        self.dropped = False
+        # Commands taken out because messages may not use them
+        self.refused = []
+
+def parse(line, now=None):
+    "Make a message from a line, taking out the ingest commands, ValueError if they are wrong"
+
+    now = time.monotonic() if now is None else now
+    found = {}
+    refused = []
+
+    def strip(match):
+        "Keep the commands for the display, note the ingest ones and refuse the rest"
+        kept = []
+        for word in match.group(1).split(";"):
+            (key, _, value) = word.partition(":")
+            if key.lower() in ("priority", "expires", "key"):
+                found[key.lower()] = value
+            elif key.strip().lower() in DISPLAY:
+                kept.append(word)
+            elif word.strip():
+                refused.append(word)
+        return "[" + ";".join(kept) + "]" if kept else ""
+
+    text = COMMANDS.sub(strip, line)
+    message = MarqueeMessage(text, key=found.get("key") or None)
+    message.refused = refused
+
+    priority = found.get("priority", "normal").lower()
+    if priority in PRIORITIES:
+        message.priority = PRIORITIES[priority]
+    elif priority.isdigit() and int(priority) <= URGENT:
+        message.priority = int(priority)
+    else:
+        raise ValueError("Unknown priority " + priority + " (low, normal, high, urgent or 0-9)")
+    if "expires" in found:
+        message.expires = now + float(found["expires"])
+    return message
+
+class MarqueeInbox(object):
+    """Messages waiting to be shown, bounded and most urgent first
+
+    There is a queue for each priority, so adding and taking a message are
+    O(1) however full the inbox is. Replaced messages are only marked as
+    dropped and skipped when they reach the front, the queues are compacted
+    if too many of them build up.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.queues = [collections.deque() for _ in range(0, URGENT + 1)]
+        # The waiting message for each key (or text)
+        self.keys = {}
+        self.entries = 0
+        self.counters = collections.Counter()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, message):
+        "Queue a message, returns False if the inbox was full of more urgent messages"
+
+        self.counters["received"] += 1
+        key = message.key if message.key is not None else message.text
+        old = self.keys.pop(key, None)
+        if old is not None:
+            old.dropped = True
+            self.counters["coalesced"] += 1
+        elif len(self.keys) >= self.capacity and not self.evict(message.priority):
+            self.counters["rejected"] += 1
+            return False
+
+        self.keys[key] = message
+        self.queues[message.priority].append(message)
+        self.entries += 1
+        if self.entries > self.capacity * 2:
+            self.compact()
+        return True
+
+    def evict(self, priority):
+        "Drop the oldest waiting message less urgent than priority, returns False if there isn't one"
+
+        for level in range(0, priority):
+            for message in self.queues[level]:
+                if not message.dropped:
+                    self.drop(message)
+                    self.counters["evicted"] += 1
+                    return True
+        return False
+
+    def drop(self, message):
+        "Forget a waiting message, it stays in its queue until it reaches the front"
+        message.dropped = True
+        del self.keys[message.key if message.key is not None else message.text]
+
+    def compact(self):
+        "Take the dropped messages out of the queues"
+        for level in range(0, URGENT + 1):
+            self.queues[level] = collections.deque(
+                message for message in self.queues[level] if not message.dropped)
+        self.entries = sum(len(queue) for queue in self.queues)
+
+    def take(self, now=None):
+        "The next message to show, None if there are none"
+
+        now = time.monotonic() if now is None else now
+        for level in range(URGENT, -1, -1):
+            queue = self.queues[level]
+            while queue:
+                message = queue.popleft()
+                self.entries -= 1
+                if message.dropped:
+                    continue
+                self.drop(message)
+                if message.expires is not None and now > message.expires:
+                    self.counters["expired"] += 1
+                    continue
+                self.counters["shown"] += 1
+                return message
+        return None
+
+    def clear(self):
+        "Forget every waiting message"
+        self.queues = [collections.deque() for _ in range(0, URGENT + 1)]
+        self.keys = {}
+        self.entries = 0
+
+    def showstats(self):
+        "Show the inbox counters"
+        print("Inbox: " + str(len(self)) + " waiting, " + ", ".join(
+            name + ": " + str(self.counters[name]) for name in
+            ("received", "shown", "coalesced", "evicted", "rejected", "expired", "malformed",
+             "refused")))
+
+def parseaddress(address):
+    "Read udp:host:port, tcp:host:port or unix:path, returns (kind, address)"
+
+    (kind, _, where) = address.partition(":")
+    kind = kind.lower()
+    if kind == "unix" and where:
+        return (kind, where)
+    if kind in ("udp", "tcp"):
+        (host, _, port) = where.rpartition(":")
+        if port.isdigit():
+            return (kind, (host or "127.0.0.1", int(port)))
+    raise ValueError("Ingest address " + address + " is not udp:host:port, tcp:host:port "
+                     "or unix:path")
+
+class MarqueeDatagrams(asyncio.DatagramProtocol):
+    "Take a message from each datagram"
+
+    def __init__(self, receive):
+        self.receive = receive
+
+    def datagram_received(self, data, addr):
+        if len(data) > LONGEST:
+            self.receive(None)
+            return
+        for line in data.decode("utf-8", "replace").splitlines():
+            self.receive(line)
+
+async def readlines(receive, reader, writer):
+    "Take a message from each line of a connection until it closes"
+
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # Longer than LONGEST, the rest of it has been thrown away
+                receive(None)
+                continue
+            if not line:
+                break
+            receive(line.decode("utf-8", "replace"))
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(address, receive):
+    """Listen for messages on address, receive is called with each line
+
+    receive is called with None for a message that was too long. Returns
+    the server (or transport), close it to stop listening.
+    """
+
+    (kind, where) = parseaddress(address)
+    if kind == "udp":
+        (transport, _) = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: MarqueeDatagrams(receive), local_addr=where)
+        return transport
+    handler = functools.partial(readlines, receive)
+    if kind == "tcp":
+        return await asyncio.start_server(handler, where[0], where[1], limit=LONGEST)
+    # A socket left behind by an earlier run is in the way
+    if os.path.exists(where) and stat.S_ISSOCK(os.stat(where).st_mode):
+        os.unlink(where)
+    return await asyncio.start_unix_server(handler, where, limit=LONGEST)
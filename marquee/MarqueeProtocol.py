@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""
+Wire protocol shared by Marquee and Receiver
+David Walker (c) 2017 Data Management & Warehousing
+
+Binary packets are a fixed header followed by packed lamp data:
+
+    magic    1 byte   0xB1, can never start an ASCII command
+    version  1 byte   VERSION
+    opcode   1 byte   OP_*
+    flags    1 byte   FLAG_*
+    sequence 4 bytes  frame number, network byte order
+    time     8 bytes  only with FLAG_TIMED, when to display the frame
+    payload           R,G,B bytes for each lamp
+
+A FRAME packet carries whole rows of the display in one datagram so it
+can be broadcast or multicast to every node at once. Its payload starts
+with the display size (stacks, rows and lamps) and the first row in the
+packet, two bytes each, followed by the RGB values of each row from left
+to right. Large displays are split into several packets of a few rows,
+FRAMESIZE bytes or less, so that they are not fragmented. Each node picks
+out its own lamps and shows them straight away.
+
+Timed packets are displayed at a time on the sender's monotonic clock
+rather than on arrival, so the sender can run ahead and each node can
+hold a few frames and show them together with its neighbours. Nodes
+work out the offset to the sender's clock with SYNC packets: the node
+sends its own time and the sender answers with that time and its own.
+
+STATS packets ask a node for its counters (FLAG_RESET also clears
+them), and the node answers with a STATS packet holding them as JSON.
+FLAG_FOLLOWS on lamp data tells a node that the sender also sent it the
+previous frame, so a jump in sequence numbers means a packet was lost
+rather than skipped because nothing changed.
+
+The original ASCII commands ("set,0,255,255,255,1,...", "show", "off",
+"shutdown") are still understood. Marquee probes each node with PROBE,
+which old receivers treat as a plain "show", and only switches a node to
+binary when it answers with HELLO.
+"""
+
+# Library Imports
+import collections
+import json
+import struct
+
+# Global static values
+
+MAGIC = 0xB1
+VERSION = 3
+
+HEADER = struct.Struct("!BBBBI")
+FRAME = struct.Struct("!HHHH")
+TIME = struct.Struct("!d")
+SYNC = struct.Struct("!dd")
+
+# Opcodes
+OP_SET = 1
+OP_SHOW = 2
+OP_OFF = 3
+OP_SHUTDOWN = 4
+OP_FRAME = 5
+OP_SYNC = 6
+OP_STATS = 7
+
+# Flags
+FLAG_REVERSED = 1
+FLAG_TIMED = 2
+FLAG_RESET = 4
+FLAG_FOLLOWS = 8
+
+# Most lamp data in a FRAME packet, more rows than fit are split across packets
+FRAMESIZE = 1400
+
+# Longest packet sent, a timed FRAME packet with FRAMESIZE bytes of lamp data
+LARGEST = HEADER.size + TIME.size + FRAME.size + FRAMESIZE
+
+# Negotiation messages
+PROBE = b"show,hello"
+HELLO = b"hello," + str(VERSION).encode("ascii")
+
+ASCII_COMMANDS = {
+    "set": OP_SET,
+    "show": OP_SHOW,
+    "off": OP_OFF,
+    "shutdown": OP_SHUTDOWN,
+}
+
+class MarqueeEncoder(object):
+    "Encode binary packets into reusable buffers"
+
+    def __init__(self, lamps):
+        self.lamps = lamps
+        self.buffers = {}
+        self.sequence = 0
+        # Sender time the current frame should be displayed at, None shows on arrival
+        self.at = None
+
+    def prepare(self, opcode, flags, size, at=None):
+        "Write a header into the buffer for an opcode, returns the buffer and payload offset"
+        start = HEADER.size
+        if at is not None:
+            flags |= FLAG_TIMED
+            start += TIME.size
+        buffer = self.buffers.get((opcode, start + size))
+        if buffer is None:
+            buffer = self.buffers[(opcode, start + size)] = bytearray(start + size)
+        HEADER.pack_into(buffer, 0, MAGIC, VERSION, opcode, flags, self.sequence)
+        if at is not None:
+            TIME.pack_into(buffer, HEADER.size, at)
+        return (buffer, start)
+
+    def set(self, lights, flags=0):
+        "Encode the lamp data for one node, lights is a bytes-like of RGB values"
+        (packet, start) = self.prepare(OP_SET, flags, self.lamps * 3, self.at)
+        packet[start:] = lights
+        return packet
+
+    def frame(self, rows, first, stacks, height, lamps):
+        """Encode rows of a display height rows high, starting at row first
+
+        rows are the RGB values of each row left to right.
+        """
+        width = stacks * lamps * 3
+        (packet, start) = self.prepare(OP_FRAME, 0, FRAME.size + len(rows) * width, self.at)
+        FRAME.pack_into(packet, start, stacks, height, lamps, first)
+        start += FRAME.size
+        for lights in rows:
+            packet[start:start+width] = lights
+            start += width
+        return packet
+
+    def encode(self, opcode, flags=0):
+        "Encode a packet without a payload"
+        return self.prepare(opcode, flags, 0)[0]
+
+    def sync(self, request, now):
+        "Encode the reply to a clock sync request with the sender's time"
+        (packet, start) = self.prepare(OP_SYNC, 0, SYNC.size)
+        SYNC.pack_into(packet, start, TIME.unpack_from(request)[0], now)
+        return packet
+
+    def next(self):
+        "Move on to the next frame"
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+class MarqueeClock(object):
+    "Estimate the offset from the local monotonic clock to the sender's"
+
+    samples = 8
+
+    def __init__(self):
+        self.history = collections.deque(maxlen=self.samples)
+        self.offset = None
+
+    def request(self, now):
+        "Encode a sync request sent at local time now"
+        packet = bytearray(HEADER.size + TIME.size)
+        HEADER.pack_into(packet, 0, MAGIC, VERSION, OP_SYNC, 0, 0)
+        TIME.pack_into(packet, HEADER.size, now)
+        return packet
+
+    def update(self, reply, now):
+        "Add the sync reply received at local time now"
+        (sent, sender) = SYNC.unpack_from(reply)
+        # The exchange with the shortest round trip has the least queueing error
+        self.history.append((now - sent, sender - (sent + now) / 2))
+        self.offset = min(self.history)[1]
+
+    def local(self, at):
+        "Convert a sender time to local monotonic time"
+        return at - self.offset
+
+def addflags(packet, flags):
+    "Set more flags on an encoded binary packet"
+    packet[3] |= flags
+    return packet
+
+def stats(counters):
+    "Encode a node's reply to a STATS request"
+    payload = json.dumps(counters, sort_keys=True).encode("utf-8")
+    packet = bytearray(HEADER.size + len(payload))
+    HEADER.pack_into(packet, 0, MAGIC, VERSION, OP_STATS, 0, 0)
+    packet[HEADER.size:] = payload
+    return packet
+
+def hello(data):
+    "Return the protocol version announced by a HELLO reply, or 0"
+    fields = bytes(data).split(b",")
+    if len(fields) == 2 and fields[0] == b"hello" and fields[1].isdigit():
+        return int(fields[1])
+    return 0
+
+def isbinary(data):
+    "Check whether a packet uses the binary format"
+    return len(data) >= HEADER.size and data[0] == MAGIC
+
+def decode(data):
+    "Decode a packet into (opcode, flags, sequence, time, payload)"
+
+    if isbinary(data):
+        (_, version, opcode, flags, sequence) = HEADER.unpack_from(data)
+        if version > VERSION:
+            return (None, flags, sequence, None, None)
+        if flags & FLAG_TIMED:
+            at = TIME.unpack_from(data, HEADER.size)[0]
+            return (opcode, flags, sequence, at, memoryview(data)[HEADER.size+TIME.size:])
+        return (opcode, flags, sequence, None, memoryview(data)[HEADER.size:])
+
+    return decodeascii(data)
+
+def framerows(stacks, lamps):
+    "How many rows fit in one FRAME packet"
+    return max(1, FRAMESIZE // (stacks * lamps * 3))
+
+def framelights(payload, column, row):
+    """Find the lamps of the node column stacks from the left of row in a FRAME payload
+
+    The lamps are returned left to right, None if the packet is for other rows.
+    ValueError if the payload is not whole rows, e.g. it was truncated.
+    """
+
+    (stacks, _, lamps, first) = FRAME.unpack_from(payload)
+    width = stacks * lamps * 3
+    if not width or (len(payload) - FRAME.size) % width:
+        raise ValueError("FRAME payload is not whole rows")
+    if column >= stacks or not first <= row < first + (len(payload) - FRAME.size) // width:
+        return None
+    start = FRAME.size + (row - first) * width + column * lamps * 3
+    return payload[start:start+lamps*3]
+
+def decodeascii(data):
+    "Decode an ASCII packet into (opcode, flags, sequence, time, payload)"
+
+    message = data.decode("utf-8", "replace").split(",")
+    opcode = ASCII_COMMANDS.get(message[0])
+    payload = None
+    if opcode == OP_SET:
+        # Fields come in groups of four, lamp number then R,G,B
+        fields = [int(field) for field in message[1:]]
+        payload = bytearray(len(fields) // 4 * 3)
+        for i in range(0, len(fields) // 4):
+            lamp = fields[i*4]
+            payload[lamp*3:lamp*3+3] = bytes(fields[i*4+1:i*4+4])
+    return (opcode, 0, None, None, payload)
+
+def encodeascii(lights, reverse=False):
+    "Encode lamp data as an ASCII set command for receivers without binary support"
+
+    lamps = len(lights) // 3
+    blinktdata = "set"
+    for light in range(0, lamps):
+        bulb = (lamps - light - 1 if reverse else light) * 3
+        blinktdata += ",%d,%d,%d,%d" % (light, lights[bulb], lights[bulb+1], lights[bulb+2])
+    return blinktdata.encode("ascii")
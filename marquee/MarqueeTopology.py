@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Cluster topology shared by Marquee and Receiver
+David Walker (c) 2017 Data Management & Warehousing
+
+The layout of the cluster is read from an INI file, marquee.ini next to
+the programmes or the file named by MARQUEE_CONFIG. Without one the
+20 node PicoCluster is used, which is the same as:
+
+    [cluster]
+    stacks = 4
+    rows = 5
+    lamps = 8
+    port = 13000
+    # {stack} and {row} count from 1
+    address = 192.168.254.{stack}{row}
+    # Leave empty to send "broadcasts" to each node in turn
+    broadcast = 192.168.254.255
+    multicast = 239.254.0.1
+    # The side of the display stack 0 is on, left or right
+    first = right
+    # Lamp 0 of each node is on its right hand side
+    reversed = yes
+
+    [nodes]
+    # Nodes that do not follow the address pattern, by stack,row counting
+    # from 0, with an optional port and forward or reversed
+    0,0 = 192.168.254.99:13005 forward
+"""
+
+# Library Imports
+import configparser
+import os
+
+# Global static values
+
+DEFAULTS = {
+    "stacks": "4",
+    "rows": "5",
+    "lamps": "8",
+    "port": "13000",
+    "address": "192.168.254.{stack}{row}",
+    "broadcast": "192.168.254.255",
+    "multicast": "239.254.0.1",
+    "first": "right",
+    "reversed": "yes",
+}
+
+class MarqueeTopology(object):
+    "The size of the display and where each node is"
+
+    def __init__(self, stacks=4, rows=5, lamps=8, port=13000, address=DEFAULTS["address"],
+                 broadcast=DEFAULTS["broadcast"], multicast=DEFAULTS["multicast"],
+                 first="right", reverse=True, nodes=None, path=None):
+        if min(stacks, rows, lamps) < 1:
+            raise ValueError("stacks, rows and lamps must all be at least 1")
+        if first not in ("left", "right"):
+            raise ValueError("first must be left or right, not " + first)
+        self.stacks = stacks
+        self.rows = rows
+        self.lamps = lamps
+        self.port = port
+        self.address = address
+        self.broadcast = broadcast
+        self.multicast = multicast
+        self.first = first
+        self.reversed = reverse
+        # Nodes that do not follow the pattern, {(stack, row): (host, port, reversed)}
+        self.nodes = dict(nodes or {})
+        self.path = path
+
+    def node(self, stack, row):
+        "The (host, port, reversed) of the node at [stack, row]"
+
+        found = self.nodes.get((stack, row))
+        if found is not None:
+            return found
+        return (self.address.format(stack=stack + 1, row=row + 1), self.port, self.reversed)
+
+    def addr(self, stack, row):
+        "The socket address of the node at [stack, row]"
+        return self.node(stack, row)[:2]
+
+    def isreversed(self, stack, row):
+        "Check whether lamp 0 of the node at [stack, row] is on its right hand side"
+        return self.node(stack, row)[2]
+
+    def column(self, stack):
+        "How many stacks there are to the left of a stack"
+        return self.stacks - stack - 1 if self.first == "right" else stack
+
+    def addresses(self):
+        "The socket addresses of all nodes as a list for each stack"
+        return [[self.addr(stack, row) for row in range(0, self.rows)]
+                for stack in range(0, self.stacks)]
+
+    def broadcastaddr(self):
+        "Where broadcasts are sent, None to send them to each node in turn"
+        return (self.broadcast, self.port) if self.broadcast else None
+
+    def multicastaddr(self):
+        "Where multicast frames are sent"
+        return (self.multicast, self.port)
+
+    def locate(self, host, port=None):
+        "Find the [stack, row] of the node with an address, or None"
+
+        for stack in range(0, self.stacks):
+            for row in range(0, self.rows):
+                (nodehost, nodeport, _) = self.node(stack, row)
+                if nodehost == host and (port is None or nodeport == port):
+                    return (stack, row)
+        return None
+
+    def loopback(self, port):
+        """The same display with every node on its own port of this machine, from port on
+
+        Broadcasts are sent to each node in turn, as they can't reach
+        loopback ports.
+        """
+
+        nodes = {}
+        for stack in range(0, self.stacks):
+            for row in range(0, self.rows):
+                nodes[(stack, row)] = ("127.0.0.1", port + stack * self.rows + row,
+                                       self.isreversed(stack, row))
+        return MarqueeTopology(stacks=self.stacks, rows=self.rows, lamps=self.lamps, port=port,
+                               address="127.0.0.1", broadcast="", first=self.first,
+                               reverse=self.reversed, nodes=nodes)
+
+    def write(self, path):
+        "Save the topology as a config file, listing every node"
+
+        config = configparser.ConfigParser()
+        config["cluster"] = {
+            "stacks": str(self.stacks),
+            "rows": str(self.rows),
+            "lamps": str(self.lamps),
+            "port": str(self.port),
+            "address": self.address,
+            "broadcast": self.broadcast or "",
+            "multicast": self.multicast,
+            "first": self.first,
+            "reversed": "yes" if self.reversed else "no",
+        }
+        config["nodes"] = {}
+        for stack in range(0, self.stacks):
+            for row in range(0, self.rows):
+                (host, port, reverse) = self.node(stack, row)
+                config["nodes"][str(stack) + "," + str(row)] = host + ":" + str(port) + \
+                    (" reversed" if reverse else " forward")
+        with open(path, "w") as file:
+            config.write(file)
+
+def defaultpath():
+    "The config file used when none is given"
+
+    return os.environ.get("MARQUEE_CONFIG") or \
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "marquee.ini")
+
+def load(path=None):
+    "Read the topology from a config file, the PicoCluster if the default file is missing"
+
+    if path is None:
+        path = defaultpath()
+        if not os.path.exists(path):
+            return MarqueeTopology()
+
+    config = configparser.ConfigParser(defaults=DEFAULTS, interpolation=None)
+    with open(path) as file:
+        config.read_file(file)
+    if not config.has_section("cluster"):
+        config.add_section("cluster")
+    cluster = config["cluster"]
+
+    reverse = cluster.getboolean("reversed")
+    port = cluster.getint("port")
+    nodes = {}
+    if config.has_section("nodes"):
+        for (key, value) in config.items("nodes"):
+            if key in DEFAULTS:
+                continue
+            nodes[parseposition(key)] = parsenode(value, port, reverse)
+
+    return MarqueeTopology(stacks=cluster.getint("stacks"), rows=cluster.getint("rows"),
+                           lamps=cluster.getint("lamps"), port=port,
+                           address=cluster.get("address"), broadcast=cluster.get("broadcast"),
+                           multicast=cluster.get("multicast"), first=cluster.get("first").lower(),
+                           reverse=reverse, nodes=nodes, path=path)
+
+def parseposition(key):
+    "Read a stack,row node key"
+
+    try:
+        (stack, row) = [int(field) for field in key.split(",")]
+    except ValueError:
+        raise ValueError("Node " + key + " is not stack,row")
+    return (stack, row)
+
+def parsenode(value, port, reverse):
+    "Read a node's host[:port] [forward|reversed], returns (host, port, reversed)"
+
+    fields = value.split()
+    if not fields or len(fields) > 2:
+        raise ValueError("Node address " + value + " is not host[:port] [forward|reversed]")
+    (host, _, nodeport) = fields[0].partition(":")
+    if len(fields) == 2:
+        if fields[1].lower() not in ("forward", "reversed"):
+            raise ValueError("Node orientation " + fields[1] + " is not forward or reversed")
+        reverse = fields[1].lower() == "reversed"
+    return (host, int(nodeport) if nodeport else port, reverse)
@@ -7,62 +7,464 @@ David Walker (c) 2017 Data Management & Warehousing
 
 # Global static values
 
-BUFFER = 1024
+# Most packets handled in one wake up, so timed frames are never starved
+BATCH = 256
+
+# Seconds between clock sync requests to the sender, once synchronised
+SYNC_INTERVAL = 2.0
 
 # Library Imports
+import argparse
+import collections
+import heapq
+import selectors
 import socket
-# Need to install from Pimoroni for this import
-import blinkt
+import struct
+import time
+
+import MarqueeProtocol
+import MarqueeTopology
+
+# Room for the longest packet Marquee sends, whole frame packets included
+BUFFER = max(2048, MarqueeProtocol.LARGEST)
 
 # Main
-def main():
+def main(argv=None):
    "Mail Function"
 
-   hosts = MarqueHosts()
+   parser = argparse.ArgumentParser(description="Receiver for the Marquee programme")
+   parser.add_argument("--config", metavar="FILE",
+                       help="cluster topology (default " + MarqueeTopology.defaultpath() + ")")
+   parser.add_argument("--stack", type=int,
+                       help="stack this node is in, found from its address if not given")
+   parser.add_argument("--row", type=int,
+                       help="row this node is in, found from its address if not given")
+   parser.add_argument("--multicast", metavar="GROUP",
+                       help="multicast group to join for frames (default from the topology)")
+   parser.add_argument("--no-multicast", action="store_true",
+                       help="don't join a multicast group, frames then only come by unicast "
+                            "or broadcast")
+   parser.add_argument("--buffer", type=int, default=8,
+                       help="number of timed frames to hold before they are due (default 8)")
+   parser.add_argument("--report", type=float, default=10.0,
+                       help="seconds between printing the packet counters (default 10)")
+   parser.add_argument("--port", type=int,
+                       help="UDP port to listen on (default from the topology)")
+   parser.add_argument("--backend", choices=sorted(BACKENDS),
+                       help="where frames are shown, 'null' throws them away (default blinkt, "
+                            "or record with --record)")
+   parser.add_argument("--record", metavar="FILE",
+                       help="write each frame shown to FILE instead of the Blinkt! lamps")
+   args = parser.parse_args(argv)
+   if args.backend is None:
+      args.backend = "record" if args.record else "blinkt"
+   if args.backend == "record" and not args.record:
+      parser.error("--backend record needs --record FILE")
+
+   try:
+      topology = MarqueeTopology.load(args.config)
+   except (OSError, ValueError) as error:
+      parser.error("can't read the topology: " + str(error))
+
+   # Where this node is, only whole frame packets need to know
+   if args.stack is None or args.row is None:
+      found = locate(topology, args.port)
+      if found is not None:
+         (args.stack, args.row) = found
+   if args.stack is not None and args.row is not None:
+      column = topology.column(args.stack)
+      reverse = topology.isreversed(args.stack, args.row)
+      if args.port is None:
+         args.port = topology.addr(args.stack, args.row)[1]
+   else:
+      print("Position unknown, whole frame packets will be ignored")
+
+   # The Blinkt!, or a stand in for it when recording (e.g. in the loopback
+   # simulator) or load testing
+   try:
+      display = BACKENDS[args.backend](topology.lamps, args.record)
+   except ImportError:
+      parser.error("the blinkt library is not installed, use --backend null or --record "
+                   "to run without it")
+
+   hosts = MarqueHosts(topology)
+   if args.port is not None:
+      hosts.udpport = args.port
    hosts.opensocket()
+   group = None if args.no_multicast else args.multicast or topology.multicast
+   if group:
+      try:
+         hosts.join(group)
+      except OSError as error:
+         print("Can't join multicast group " + group + ", multicast frames will be missed: " +
+               str(error))
 
-   # Set Blinkt! brightness
-   blinkt.set_brightness(0.1)
-
-   # Enter main loop
-   print ("Waiting to receive messages ...")
-   while True:
-      # Receive packet
-      (data,addr) = hosts.receive()
-
-      # Split up string into data points
-      message = list(data.decode('utf-8').split(','))
-
-      # Get the action from the first position
-      action = message[0]
-      del message[0]
-
-      # Process actions
+   # Wake up when packets arrive
+   selector = selectors.DefaultSelector()
+   selector.register(hosts.socket, selectors.EVENT_READ)
 
-      if action == 'set':
-         print('set')
+   # Timed frames waiting to be shown and the offset to the sender's clock
+   frames = MarqueeFrames(args.buffer)
+   clock = MarqueeProtocol.MarqueeClock()
+   sender = None
+   nextsync = None
 
-         # For each lamp
-         for i in range(8):
-            # Set the RGB number
-           blinkt.set_pixel(int(message[i*4]), int(message[i*4+1]), int(message[i*4+2]), int(message[i*4+3]))
+   # Lamps set since the last show, they are only applied when shown
+   staged = None
 
-      elif action == 'show':
-         print('show')
-         blinkt.show()
+   stats = MarqueeStats(args.report)
 
-      elif action == 'shutdown':
-         print('shutdown')
-         break
-
-      else:
-         print("Unknown command received: " + BlinktCommand)
+   # Enter main loop
+   print ("Waiting to receive messages ...")
+   running = True
+   while running:
+      now = time.monotonic()
+
+      # Show the newest frame that is due, older ones have been overtaken
+      due = frames.due(now)
+      if due is not None:
+         display.apply(due[1], due[2])
+         display.show()
+         stats.count('shown')
+         stats.latency(time.monotonic() - due[0])
+
+      # Keep the offset to the sender's clock up to date
+      if nextsync is not None and now >= nextsync:
+         hosts.socket.sendto(clock.request(now), sender)
+         nextsync = now + (SYNC_INTERVAL if clock.offset is not None else 0.25)
+
+      stats.report(now)
+
+      # Wait for packets, or wake up when the next frame, sync or report is due
+      wakeups = [wakeup for wakeup in (frames.next(), nextsync, stats.nextreport)
+                 if wakeup is not None]
+      if not selector.select(max(min(wakeups) - now, 0) if wakeups else None):
+         continue
+      woke = time.monotonic()
+
+      # Work through everything that has arrived, only the newest frame
+      # before the last show is applied
+      showing = None
+      for (data, addr) in hosts.drain(BATCH):
+         stats.count('received')
+
+         # Answer the protocol probe so the sender switches us to binary
+         if data == MarqueeProtocol.PROBE:
+            hosts.socket.sendto(MarqueeProtocol.HELLO, addr)
+            continue
+
+         # Decode binary packets, or ASCII ones from older senders
+         try:
+            (action, flags, sequence, at, payload) = MarqueeProtocol.decode(data)
+         except (ValueError, IndexError):
+            stats.count('malformed')
+            continue
+
+         # Count lamp data and look for lost packets, whole frame packets
+         # are only counted once they are known to hold this node's row
+         if action in (MarqueeProtocol.OP_SET, MarqueeProtocol.OP_SHOW):
+            stats.count('lamp')
+            if action == MarqueeProtocol.OP_SET and sequence is not None:
+               stats.sequence(sequence, flags)
+
+         # Timed frames are held until they are due on the sender's clock,
+         # until the clock is synchronised they are shown straight away
+         if at is not None and sender != addr:
+            sender = addr
+            nextsync = time.monotonic()
+         timed = at is not None and clock.offset is not None
+
+         # Process actions
+
+         if action == MarqueeProtocol.OP_FRAME:
+            # Pick out our own lamps
+            if args.stack is None or args.row is None:
+               stats.count('unplaced')
+               continue
+            try:
+               lights = MarqueeProtocol.framelights(payload, column, args.row)
+            except (ValueError, struct.error):
+               stats.count('malformed')
+               continue
+            if lights is None:
+               # Large displays are sent a few rows to a packet
+               continue
+            stats.count('lamp')
+            stats.sequence(sequence, flags)
+            if timed:
+               frames.add(clock.local(at), sequence, lights, reverse)
+            else:
+               if showing is not None:
+                  stats.count('dropped')
+               showing = (bytes(lights), reverse)
+
+         elif action == MarqueeProtocol.OP_SET:
+            # The sender says which way round its lamps are, the node's own
+            # orientation is kept for whole frame packets
+            setreverse = bool(flags & MarqueeProtocol.FLAG_REVERSED)
+            if timed:
+               frames.add(clock.local(at), sequence, payload, setreverse)
+            elif at is not None:
+               if showing is not None:
+                  stats.count('dropped')
+               showing = (bytes(payload), setreverse)
+            else:
+               if staged is not None:
+                  stats.count('dropped')
+               staged = (bytes(payload), setreverse)
+
+         elif action == MarqueeProtocol.OP_SHOW:
+            if showing is not None:
+               stats.count('dropped')
+            showing = staged or ()
+            staged = None
+
+         elif action == MarqueeProtocol.OP_SYNC:
+            clock.update(payload, time.monotonic())
+
+         elif action == MarqueeProtocol.OP_STATS:
+            if flags & MarqueeProtocol.FLAG_RESET:
+               stats.reset()
+            hosts.socket.sendto(MarqueeProtocol.stats(stats.snapshot()), addr)
+
+         elif action == MarqueeProtocol.OP_OFF:
+            print('off')
+            frames.clear()
+            staged = showing = None
+            display.clear()
+            display.show()
+
+         elif action == MarqueeProtocol.OP_SHUTDOWN:
+            print('shutdown')
+            running = False
+            break
+
+         else:
+            stats.count('unknown')
+
+      if showing is not None:
+         if showing:
+            display.apply(*showing)
+         display.show()
+         stats.count('shown')
+         stats.latency(time.monotonic() - woke)
 
    # Close the connections
+   stats.report(None)
    hosts.closesocket()
+   display.close()
 
    return 0
 
+def locate(topology, port):
+   "Find this node's [stack, row] from the address it reaches the cluster on, or None"
+
+   probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   try:
+      # Nothing is sent, this only picks the interface
+      probe.connect(topology.addr(0, 0))
+      host = probe.getsockname()[0]
+   except OSError:
+      return None
+   finally:
+      probe.close()
+   return topology.locate(host, port)
+
+class MarqueeBackend(object):
+    """Somewhere to show a node's lamps, the null backend that shows nothing
+
+    A frame is applied to a back buffer of RGB bytes in one go, and show()
+    swaps it to the front and hands it to write(). Backends only override
+    write(), and close() if they have anything to release.
+    """
+
+    def __init__(self, lamps, path=None):
+        self.lamps = lamps
+        self.back = bytearray(lamps * 3)
+        self.front = bytearray(lamps * 3)
+
+    def apply(self, lights, reverse):
+        "Set the first lamps from RGB values, reversing them if they are in reverse lamp order"
+
+        size = min(len(lights) // 3, self.lamps) * 3
+        if not reverse or not size:
+            self.back[:size] = lights[:size]
+            return
+        # Lamp i comes from lamp lamps - i - 1, one channel at a time
+        self.back[0:size:3] = lights[size-3::-3]
+        self.back[1:size:3] = lights[size-2::-3]
+        self.back[2:size:3] = lights[size-1::-3]
+
+    def clear(self):
+        "Turn off all lamps"
+        self.back[:] = bytes(len(self.back))
+
+    def show(self):
+        "Show the back buffer, it then starts again from what is shown"
+        (self.front, self.back) = (self.back, self.front)
+        self.back[:] = self.front
+        self.write(self.front)
+
+    def write(self, lights):
+        "Send the RGB values of every lamp from lamp 0 to the device"
+        pass
+
+    def close(self):
+        "Release the device"
+        pass
+
+class MarqueeBlinkt(MarqueeBackend):
+    "The Blinkt! lamps, which are only set again when the frame has changed"
+
+    # Blinkt! LEDs are too bright to look at on full
+    brightness = 0.1
+
+    def __init__(self, lamps, path=None):
+        # Need to install from Pimoroni for this import
+        import blinkt
+        self.blinkt = blinkt
+        MarqueeBackend.__init__(self, min(lamps, blinkt.NUM_PIXELS))
+        self.shown = bytearray(self.lamps * 3)
+        blinkt.set_brightness(self.brightness)
+
+    def write(self, lights):
+        if lights != self.shown:
+            set_pixel = self.blinkt.set_pixel
+            for (lamp, red, green, blue) in zip(range(0, self.lamps), lights[0::3], lights[1::3],
+                                                lights[2::3]):
+                set_pixel(lamp, red, green, blue)
+            self.shown[:] = lights
+        self.blinkt.show()
+
+class MarqueeRecorder(MarqueeBackend):
+    """Record what would be shown on a Blinkt!
+
+    Each show writes a line with the local monotonic time and the R,G,B
+    values of every lamp, from lamp 0.
+    """
+
+    def __init__(self, lamps, path):
+        MarqueeBackend.__init__(self, lamps)
+        self.file = open(path, "w")
+
+    def write(self, lights):
+        self.file.write("%.6f %s\n" % (time.monotonic(), " ".join(
+            "%d,%d,%d" % (lights[lamp], lights[lamp+1], lights[lamp+2])
+            for lamp in range(0, len(lights), 3))))
+
+    def close(self):
+        self.file.close()
+
+BACKENDS = {
+    "blinkt": MarqueeBlinkt,
+    "null": MarqueeBackend,
+    "record": MarqueeRecorder,
+}
+
+def readrecording(path):
+    "Read a recording back, returns a list of (time, lamps) with lamps as bytes from lamp 0"
+
+    shows = []
+    with open(path) as file:
+        for line in file:
+            fields = line.split()
+            shows.append((float(fields[0]), bytes(int(colour) for pixel in fields[1:]
+                                                 for colour in pixel.split(","))))
+    return shows
+
+class MarqueeFrames(object):
+    "Timed frames waiting to be displayed, earliest first"
+
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self.heap = []
+
+    def add(self, due, sequence, lights, reverse):
+        "Hold the lamps of a frame until local time due"
+        heapq.heappush(self.heap, (due, sequence, bytes(lights), reverse))
+        # Too far behind, drop the oldest frame rather than fall further back
+        if len(self.heap) > self.size:
+            heapq.heappop(self.heap)
+
+    def due(self, now):
+        "Remove the frames that are due and return (due, lights, reverse) of the newest one"
+        newest = None
+        while self.heap and self.heap[0][0] <= now:
+            (due, _, lights, reverse) = heapq.heappop(self.heap)
+            newest = (due, lights, reverse)
+        return newest
+
+    def next(self):
+        "When the next frame is due"
+        return self.heap[0][0] if self.heap else None
+
+    def clear(self):
+        "Drop all frames"
+        self.heap = []
+
+class MarqueeStats(object):
+    """Count what the receiver has done and print the counters now and again
+
+    Apply latency is the time from a show (or a timed frame falling due)
+    to the lamps being updated, the last few hundred are kept so that
+    percentiles can be sent back to Marquee when it asks for them.
+    """
+
+    samples = 500
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counters = collections.Counter()
+        self.reported = collections.Counter()
+        self.latencies = collections.deque(maxlen=self.samples)
+        self.lastsequence = None
+        self.started = time.monotonic()
+        self.nextreport = time.monotonic() + interval if interval > 0 else None
+
+    def count(self, name, amount=1):
+        "Add to a counter"
+        self.counters[name] += amount
+
+    def latency(self, seconds):
+        "Record how long it took to apply a frame"
+        self.latencies.append(seconds)
+
+    def sequence(self, sequence, flags):
+        "Count a gap when a frame the sender says follows on from the last one does not"
+        if flags & MarqueeProtocol.FLAG_FOLLOWS and self.lastsequence is not None and \
+                sequence != (self.lastsequence + 1) & 0xFFFFFFFF:
+            self.count('gaps')
+        self.lastsequence = sequence
+
+    def reset(self):
+        "Clear the counters"
+        self.counters.clear()
+        self.reported.clear()
+        self.latencies.clear()
+        self.started = time.monotonic()
+
+    def snapshot(self):
+        "The counters and apply latency percentiles (in milliseconds)"
+        samples = sorted(self.latencies)
+        snapshot = dict(self.counters)
+        snapshot['uptime'] = round(time.monotonic() - self.started, 1)
+        for (name, fraction) in (('p50', 0.5), ('p99', 0.99), ('max', 1.0)):
+            if samples:
+                snapshot[name] = round(samples[min(int(fraction * len(samples)),
+                                                   len(samples) - 1)] * 1000, 2)
+        return snapshot
+
+    def report(self, now):
+        "Print the counters if they have changed and it is time, or now if now is None"
+        if now is not None and (self.nextreport is None or now < self.nextreport):
+            return
+        if self.counters != self.reported:
+            print(", ".join(name + ": " + str(self.counters[name])
+                            for name in sorted(self.counters)))
+            self.reported = self.counters.copy()
+        if now is not None:
+            self.nextreport = now + self.interval
+
 class MarqueHosts(object):
     "This defines the list of blinkt! hosts in the cluster and their position [stack, row]"
 
@@ -70,12 +472,15 @@ class MarqueHosts(object):
 
     addr = []
 
-    testaddr = ("192.168.1.3", udpport)
-
-    broadcastaddr = ("192.168.1.255", udpport)
+    broadcastaddr = None
 
     socket = None
 
+    def __init__(self, topology):
+        self.udpport = topology.port
+        self.addr = topology.addresses()
+        self.broadcastaddr = topology.broadcastaddr()
+
     def opensocket(self):
         "Open a socket"
 
@@ -86,28 +491,40 @@ class MarqueHosts(object):
         # Allow incoming broadcasts
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         # Set socket to non-blocking mode
-        #self.socket.setblocking(False)
+        self.socket.setblocking(False)
         # Accept Connections on port
         self.socket.bind(("", self.udpport))
 
+    def join(self, group):
+        "Join a multicast group to receive whole frames"
+
+        membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
     def closesocket(self):
         "Close a socket"
 
         self.socket.close()
 
-    def transmit(self, data, row, stack):
-        "Message a single node"
-
-        self.socket.sendto(bytearray(data, "UTF-8"), self.addr[stack][row])
-        self.socket.sendto(bytearray(data, "UTF-8"), self.testaddr)
+    def drain(self, limit):
+        "Receive up to limit packets that are already waiting"
 
-    def receive(self):
-        return self.socket.recvfrom(BUFFER)
+        packets = []
+        while len(packets) < limit:
+            try:
+                packets.append(self.socket.recvfrom(BUFFER))
+            except BlockingIOError:
+                break
+        return packets
 
     def broadcast(self, data):
-        "Broadcast to all nodes"
+        "Broadcast to all nodes, or send to each in turn if there is no broadcast address"
 
-        self.socket.sendto(bytearray(data, "UTF-8"), self.broadcastaddr)
+        if self.broadcastaddr is None:
+            for addr in [addr for stack in self.addr for addr in stack]:
+                self.socket.sendto(bytearray(data, "UTF-8"), addr)
+        else:
+            self.socket.sendto(bytearray(data, "UTF-8"), self.broadcastaddr)
 
 if __name__ == "__main__":
     main()
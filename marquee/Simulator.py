@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Loopback cluster simulator and end-to-end benchmark for the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+Starts a Receiver for every node of the cluster (the same size and shape
+as the configured topology) on this machine, each on its own port and
+recording what it shows to a file instead of driving a
+Blinkt!, scrolls a message across them with Marquee and then works out
+from the recordings how well the frames got through.
+
+Each node's recording is matched against the frames Marquee sent it: a
+frame counts as lost when a node never showed lamps it was sent, and
+latency is the time from sending a frame to a node showing it (including
+the lead time, if there is one). All the processes share the monotonic
+clock so no clock sync is needed to compare the times. Receiver CPU time
+is for the whole life of the processes, so it includes starting them.
+
+Usage: Simulator.py [--length 10,100] [--sleep 0.05,0.01] [--mode unicast] ...
+"""
+
+# Library Imports
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import Marquee
+from Marquee import ROWS, STACKS, LAMPS
+from Benchmark import message, render
+import Receiver
+
+RECEIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Receiver.py")
+
+# Seconds to wait for the receivers to start and to stop
+STARTUP = 5.0
+SHUTDOWN = 2.0
+
+def main(argv=None):
+    "Main Function"
+
+    parser = argparse.ArgumentParser(description="Benchmark Marquee against simulated nodes")
+    parser.add_argument("--length", default="10,100",
+                        help="message lengths in characters, comma separated (default 10,100)")
+    parser.add_argument("--sleep", default="0.05,0.01",
+                        help="sleep times between steps, comma separated (default 0.05,0.01)")
+    parser.add_argument("--mode", default="unicast", choices=("unicast", "broadcast"),
+                        help="how frames are sent (default unicast)")
+    parser.add_argument("--protocol", default="auto", choices=("auto", "binary", "ascii"),
+                        help="wire protocol (default auto)")
+    parser.add_argument("--lead", default="0",
+                        help="seconds ahead of display time that frames are sent (default 0)")
+    parser.add_argument("--late", default="skip", choices=Marquee.MarqueeScheduler.policies,
+                        help="late frame policy (default skip)")
+    parser.add_argument("--port", type=int, default=14000,
+                        help="port of the first node, the others follow on (default 14000)")
+    args = parser.parse_args(argv)
+
+    print("Length   Sleep  Frames    fps  shown/s   p50ms   p90ms   p99ms   maxms  Loss%"
+          "  send us/frame  recv us/frame")
+    for length in [int(value) for value in args.length.split(",")]:
+        for sleep in [float(value) for value in args.sleep.split(",")]:
+            result = simulate(args, length, sleep)
+            print("%6d %7.3f %7d %6.1f %8.1f %7.2f %7.2f %7.2f %7.2f %6.2f %14.1f %14.1f" % (
+                length, sleep, result["frames"], result["fps"], result["shown"],
+                result["p50"], result["p90"], result["p99"], result["max"], result["loss"],
+                result["sendcpu"], result["recvcpu"]))
+    return 0
+
+def simulate(args, length, sleep):
+    "Scroll one message across a fresh set of simulated nodes and measure it"
+
+    display = render(message(length))
+    steps = display.width - STACKS * LAMPS
+    Marquee.MarqueeSleepTime.seconds = sleep
+
+    with tempfile.TemporaryDirectory() as directory:
+        cluster = MarqueeCluster(directory, args.port)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cluster.start()
+        hosts = cluster.connect(args.protocol)
+        hosts.setmode(args.mode)
+        hosts.setlead(args.lead)
+        # Keyframes resend unchanged lamps, which can't be told apart from the
+        # frame that first changed them
+        hosts.setkeyframe("0")
+
+        # Scroll the message the way Marquee sends frames, noting when each frame went
+        scheduler = Marquee.MarqueeScheduler(args.late)
+        sent = []
+        cpu = time.process_time()
+        started = time.monotonic()
+        offset = 0
+        scheduler.start()
+        while offset < steps:
+            sent.append((time.monotonic(), offset))
+            Marquee.sendframe(hosts, display, offset, scheduler.current)
+            offset += scheduler.wait(hosts.service)
+        elapsed = time.monotonic() - started
+        cpu = time.process_time() - cpu
+
+        # Let the last timed frames fall due
+        deadline = time.monotonic() + hosts.lead + 0.25
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            hosts.service(remaining)
+
+        cluster.stop(hosts)
+        hosts.closesocket()
+        receivercpu = cpu_seconds(resource.getrusage(resource.RUSAGE_CHILDREN)) - \
+            cpu_seconds(children)
+
+        latencies = []
+        changes = 0
+        shown = 0
+        for stack in range(0, STACKS):
+            for row in range(0, ROWS):
+                expected = nodeframes(cluster.topology, display, sent, stack, row)
+                recording = Receiver.readrecording(cluster.recording(stack, row))
+                shown += len(recording)
+                changes += len(expected)
+                latencies += match(expected, recording)
+
+    latencies.sort()
+    nodes = STACKS * ROWS
+    result = {
+        "frames": len(sent),
+        "fps": len(sent) / elapsed if elapsed else 0.0,
+        "shown": shown / nodes / elapsed if elapsed else 0.0,
+        "loss": 100.0 * (changes - len(latencies)) / changes if changes else 0.0,
+        "sendcpu": cpu * 1e6 / max(len(sent), 1),
+        "recvcpu": receivercpu * 1e6 / max(len(sent) * nodes, 1),
+    }
+    for (name, fraction) in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)):
+        result[name] = latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000 \
+            if latencies else 0.0
+    return result
+
+def cpu_seconds(usage):
+    "User and system CPU time from resource usage"
+    return usage.ru_utime + usage.ru_stime
+
+def nodeframes(topology, display, sent, stack, row):
+    "The frames that changed a node's lamps, as a list of (time sent, lamps from lamp 0)"
+
+    frames = []
+    last = None
+    start = topology.column(stack) * LAMPS
+    reverse = topology.isreversed(stack, row)
+    for (when, offset) in sent:
+        # The window is left to right, lamp 0 may be on the right
+        lamps = bytes(display.window(row, offset + start, LAMPS))
+        if reverse:
+            lamps = b"".join(lamps[(LAMPS-lamp-1)*3:(LAMPS-lamp)*3] for lamp in range(0, LAMPS))
+        if lamps != last:
+            frames.append((when, lamps))
+            last = lamps
+    return frames
+
+def match(expected, recording):
+    """Pair the frames a node showed with the frames it was sent, returns the latencies
+
+    Both are in order, so each show is matched with the first frame after
+    the last match that has the same lamps. Shows that repeat the lamps
+    already showing (ascii nodes are told to show every frame) are skipped.
+    """
+
+    latencies = []
+    last = None
+    position = 0
+    for (when, lamps) in recording:
+        if lamps == last:
+            continue
+        last = lamps
+        for candidate in range(position, len(expected)):
+            if expected[candidate][1] == lamps:
+                latencies.append(when - expected[candidate][0])
+                position = candidate + 1
+                break
+    return latencies
+
+class MarqueeCluster(object):
+    "A Receiver process for every node, listening on the loopback interface"
+
+    def __init__(self, directory, port):
+        self.directory = directory
+        self.processes = []
+
+        # The configured topology with every node moved to its own loopback port
+        self.topology = Marquee.TOPOLOGY.loopback(port)
+        self.config = os.path.join(directory, "marquee.ini")
+        self.topology.write(self.config)
+
+    def recording(self, stack, row):
+        "The file a node records its frames in"
+        return os.path.join(self.directory, "node" + str(stack) + str(row) + ".txt")
+
+    def start(self):
+        "Start the receivers"
+
+        for stack in range(0, STACKS):
+            for row in range(0, ROWS):
+                self.processes.append(subprocess.Popen(
+                    [sys.executable, RECEIVER, "--config", self.config, "--stack", str(stack),
+                     "--row", str(row), "--report", "0", "--record", self.recording(stack, row)],
+                    stdout=subprocess.DEVNULL))
+
+    def connect(self, protocol):
+        "Open Marquee's connection to the receivers once they are all listening"
+
+        hosts = Marquee.MarqueeHosts(self.topology)
+        hosts.udpport_sender = 0
+        hosts.opensocket()
+
+        # Every receiver answers the probe once it is up
+        deadline = time.monotonic() + STARTUP
+        while len(hosts.binary) < len(hosts.nodes()):
+            if time.monotonic() > deadline:
+                self.stop(hosts)
+                raise RuntimeError(str(len(hosts.nodes()) - len(hosts.binary)) + \
+                    " simulated nodes did not start")
+            hosts.negotiate("auto", 0.1)
+        if protocol != "auto":
+            hosts.negotiate(protocol)
+        return hosts
+
+    def stop(self, hosts):
+        "Shut the receivers down and wait for them to finish"
+
+        hosts.broadcast("shutdown")
+        deadline = time.monotonic() + SHUTDOWN
+        for process in self.processes:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0.01))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.processes = []
+
+if __name__ == "__main__":
+    sys.exit(main())
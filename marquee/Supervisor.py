@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+"""
+Start, check and restart the Receivers of the Marquee programme
+David Walker (c) 2017 Data Management & Warehousing
+
+The Receivers of every node are started at the same time, a few SSH
+sessions at once (--workers), and a node only counts as up once its
+Receiver answers a UDP probe. Receivers that are already answering are
+left alone unless --restart is given. With --watch the nodes go on being
+probed, and a node that misses a few probes in a row has its Receiver
+started again.
+
+--local runs the Receivers as processes on this machine instead, each on
+its own loopback port and recording what it shows to a file in the
+directory given rather than driving a Blinkt!, so the supervisor can be
+tried out without a cluster. Point Marquee at the marquee.ini written to
+the directory (with MARQUEE_CONFIG) to send them frames.
+
+Receivers keep running when the supervisor stops, --stop shuts them down.
+
+Usage: Supervisor.py [--config FILE] [--workers 8] [--watch] [--local DIRECTORY] ...
+"""
+
+# Library Imports
+import argparse
+import collections
+import concurrent.futures
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+import MarqueeProtocol
+import MarqueeTopology
+
+RECEIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Receiver.py")
+
+# Where the programme is on the nodes
+REMOTE = "/home/pi/pi-code/marquee"
+
+# Seconds between probes of a node that has not answered
+PROBE_INTERVAL = 0.25
+
+def main(argv=None):
+    "Main Function"
+
+    parser = argparse.ArgumentParser(description="Start and supervise the Marquee Receivers")
+    parser.add_argument("--config", metavar="FILE",
+                        help="cluster topology (default " + MarqueeTopology.defaultpath() + ")")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Receivers started at the same time (default 8)")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds to wait for started Receivers to answer (default 10)")
+    parser.add_argument("--restart", action="store_true",
+                        help="start every Receiver again, even those already answering")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep probing the nodes and restart Receivers that stop answering")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="seconds between probes when watching (default 2)")
+    parser.add_argument("--misses", type=int, default=3,
+                        help="probes a node can miss in a row before it is restarted (default 3)")
+    parser.add_argument("--stop", action="store_true", help="shut every Receiver down")
+    parser.add_argument("--user", default="pi", help="user to log in to the nodes as (default pi)")
+    parser.add_argument("--ssh-host", metavar="PATTERN",
+                        help="address to log in to for each node, with {stack} and {row} "
+                             "counting from 1 e.g. 10.10.10.{stack}{row} (default the node's "
+                             "address in the topology)")
+    parser.add_argument("--remote", default=REMOTE,
+                        help="where the programme is on the nodes (default " + REMOTE + ")")
+    parser.add_argument("--local", metavar="DIRECTORY",
+                        help="run the Receivers on this machine, keeping their recordings, "
+                             "logs and topology in DIRECTORY")
+    parser.add_argument("--port", type=int, default=14000,
+                        help="port of the first local Receiver, the others follow on "
+                             "(default 14000)")
+    args = parser.parse_args(argv)
+
+    try:
+        topology = MarqueeTopology.load(args.config)
+    except (OSError, ValueError) as error:
+        parser.error("can't read the topology: " + str(error))
+
+    if args.local:
+        os.makedirs(args.local, exist_ok=True)
+        topology = topology.loopback(args.port)
+        config = os.path.join(args.local, "marquee.ini")
+        topology.write(config)
+        launcher = MarqueeLocalLauncher(config, args.local)
+    else:
+        launcher = MarqueeSSHLauncher(topology, args.user, args.ssh_host, args.remote)
+
+    supervisor = MarqueeSupervisor(topology, launcher, args.workers)
+    try:
+        if args.stop:
+            supervisor.stopall()
+            return 0
+        ready = supervisor.startall(args.timeout, args.restart)
+        if args.watch:
+            supervisor.watch(args.interval, args.misses, args.timeout)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        supervisor.close()
+    return 0 if len(ready) == len(supervisor.nodes) else 1
+
+class MarqueeSupervisor(object):
+    "Start the Receivers of every node and restart them when they stop answering"
+
+    def __init__(self, topology, launcher, workers):
+        self.launcher = launcher
+        self.nodes = [(stack, row) for stack in range(0, topology.stacks)
+                      for row in range(0, topology.rows)]
+
+        # Replies come from the address the Receiver is bound to
+        self.addrs = {}
+        for node in self.nodes:
+            (host, port) = topology.addr(*node)
+            try:
+                host = socket.gethostbyname(host)
+            except OSError:
+                pass
+            self.addrs[node] = (host, port)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(("", 0))
+        self.pool = concurrent.futures.ThreadPoolExecutor(max(workers, 1))
+
+        # Probes missed in a row and restarts for each node
+        self.misses = collections.Counter()
+        self.restarts = collections.Counter()
+
+    def probe(self, nodes, timeout):
+        "Probe nodes until they have all answered or timeout passes, returns those that answered"
+
+        waiting = {self.addrs[node]: node for node in nodes}
+        answered = set()
+        deadline = time.monotonic() + timeout
+        nextprobe = time.monotonic()
+        while waiting:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= nextprobe:
+                for addr in waiting:
+                    try:
+                        self.socket.sendto(MarqueeProtocol.PROBE, addr)
+                    except OSError:
+                        pass
+                nextprobe = now + PROBE_INTERVAL
+            if not select.select([self.socket], [], [], min(nextprobe, deadline) - now)[0]:
+                continue
+            while True:
+                try:
+                    (data, addr) = self.socket.recvfrom(64)
+                except OSError:
+                    break
+                if MarqueeProtocol.hello(data) and addr in waiting:
+                    answered.add(waiting.pop(addr))
+        return answered
+
+    def launch(self, nodes, timeout, restart=False):
+        "Start the Receivers of nodes at the same time and wait for them to answer"
+
+        started = time.monotonic()
+        futures = {self.pool.submit(self.launcher.start, stack, row, restart): (stack, row)
+                   for (stack, row) in nodes}
+        launched = []
+        for future in concurrent.futures.as_completed(futures):
+            node = futures[future]
+            try:
+                error = future.result()
+            except (OSError, subprocess.SubprocessError) as exception:
+                error = str(exception)
+            if error:
+                print("Node %d,%d %s:%d could not be started: %s" % (node + self.addrs[node] +
+                                                                    (error,)))
+            else:
+                launched.append(node)
+
+        ready = self.probe(launched, timeout)
+        for node in sorted(launched):
+            if node in ready:
+                self.misses[node] = 0
+            else:
+                print("Node %d,%d %s:%d started but is not answering" % (node + self.addrs[node]))
+        print("%d of %d Receivers started and answering in %.2fs" % (
+            len(ready), len(nodes), time.monotonic() - started))
+        return ready
+
+    def startall(self, timeout, restart=False):
+        "Start every Receiver that is not already answering, returns the nodes that are up"
+
+        running = set() if restart else self.probe(self.nodes, 1.0)
+        if running:
+            print("%d Receivers are already running" % len(running))
+        starting = [node for node in self.nodes if node not in running]
+        if not starting:
+            return running
+        return running | self.launch(starting, timeout, restart)
+
+    def watch(self, interval, misses, timeout):
+        "Probe every node every interval and restart those that stop answering, until interrupted"
+
+        print("Watching %d nodes, Ctrl-C to stop" % len(self.nodes))
+        while True:
+            started = time.monotonic()
+            answered = self.probe(self.nodes, min(interval, 1.0))
+            dead = []
+            for node in self.nodes:
+                if node in answered:
+                    self.misses[node] = 0
+                    continue
+                self.misses[node] += 1
+                # A local Receiver that has exited is restarted straight away
+                if self.misses[node] >= misses or self.launcher.alive(*node) is False:
+                    dead.append(node)
+            if dead:
+                for node in dead:
+                    self.restarts[node] += 1
+                    print("Restarting node %d,%d %s:%d (restart %d)" % (
+                        node + self.addrs[node] + (self.restarts[node],)))
+                self.launch(dead, timeout, True)
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+    def stopall(self):
+        "Tell every Receiver to shut down"
+
+        for node in self.nodes:
+            try:
+                self.socket.sendto(b"shutdown", self.addrs[node])
+            except OSError as error:
+                print("Node %d,%d %s:%d could not be sent shutdown: %s" % (
+                    node + self.addrs[node] + (error,)))
+        print("Shutdown sent to %d Receivers" % len(self.nodes))
+
+    def close(self):
+        "Release the socket and the workers"
+        self.pool.shutdown()
+        self.socket.close()
+
+class MarqueeSSHLauncher(object):
+    "Start Receivers on the nodes over SSH, with startReceiver.bash"
+
+    # Seconds an SSH session may take to start a Receiver
+    timeout = 30
+
+    def __init__(self, topology, user, host, remote):
+        self.topology = topology
+        self.user = user
+        self.host = host
+        self.remote = remote
+
+    def start(self, stack, row, restart=False):
+        "Start the Receiver of a node, returns an error message or None"
+
+        if self.host:
+            host = self.host.format(stack=stack + 1, row=row + 1)
+        else:
+            host = self.topology.addr(stack, row)[0]
+        command = "/bin/bash " + self.remote + "/startReceiver.bash --stack " + str(stack) + \
+            " --row " + str(row)
+        if restart:
+            # The brackets stop pkill matching the shell running this command
+            command = "pkill -f 'marquee/[R]eceiver.py'; " + command
+        result = subprocess.run(
+            ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=5", self.user + "@" + host,
+             command], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, timeout=self.timeout)
+        if result.returncode:
+            return result.stderr.decode("utf-8", "replace").strip() or \
+                "ssh exited with " + str(result.returncode)
+        return None
+
+    def alive(self, stack, row):
+        "Whether a node's Receiver is running, None as it can only be told from probes"
+        return None
+
+class MarqueeLocalLauncher(object):
+    "Start Receivers as processes on this machine, recording instead of driving a Blinkt!"
+
+    def __init__(self, config, directory):
+        self.config = config
+        self.directory = directory
+        self.processes = {}
+
+    def start(self, stack, row, restart=False):
+        "Start the Receiver of a node, stopping any it already has, returns None"
+
+        process = self.processes.pop((stack, row), None)
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        name = os.path.join(self.directory, "node" + str(stack) + "." + str(row))
+        with open(name + ".log", "a") as log:
+            # In a session of its own so that it outlives the supervisor
+            self.processes[(stack, row)] = subprocess.Popen(
+                [sys.executable, RECEIVER, "--config", self.config, "--stack", str(stack),
+                 "--row", str(row), "--record", name + ".txt"],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=True)
+        return None
+
+    def alive(self, stack, row):
+        "Whether a node's Receiver is running, None if it was not started here"
+        process = self.processes.get((stack, row))
+        return None if process is None else process.poll() is None
+
+if __name__ == "__main__":
+    sys.exit(main())
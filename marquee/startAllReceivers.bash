@@ -1,6 +1,5 @@
-for i in 11 12 13 14 15 21 22 23 24 25 31 32 33 34 35 41 42 43 44 45
-do
-   echo "Starting Receiver on 10.10.10.${i}"
-   ssh pi@10.10.10.${i} "/bin/bash /home/pi/pi-code/marquee/startReceiver.bash"
-   echo "Done"
-done 
+#!/bin/bash
+
+# Start the Receivers on all the nodes at once and check they answer,
+# see Supervisor.py --help for --watch, --restart and --stop
+exec python3 "$(dirname "$0")/Supervisor.py" --ssh-host "10.10.10.{stack}{row}" "$@"
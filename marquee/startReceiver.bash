@@ -1,3 +1,3 @@
 #!/bin/bash
 
-nohup /home/pi/pi-code/marquee/Receiver.py 2>&1 1>/home/pi/pi-code/marquee/Receiver.log &
+nohup /home/pi/pi-code/marquee/Receiver.py "$@" 2>&1 1>/home/pi/pi-code/marquee/Receiver.log &